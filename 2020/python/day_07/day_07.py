@@ -9,6 +9,12 @@
 #
 
 import sys
+import os
+import re
+import gc
+import contextlib
+import json
+import multiprocessing
 from argparse import ArgumentParser
 from pathlib import Path
 
@@ -60,6 +66,80 @@ def test_example_2(example_rules_2):
     assert trace_down(all_bags, all_bags["shiny gold"]) == 126
 
 
+def test_closure_matches_trace(example_rules_1, example_rules_2):
+    for rules in [example_rules_1, example_rules_2]:
+        all_bags = get_bags_from_rules(rules)
+        closure = BagClosure(all_bags)
+        for color, bag in all_bags.items():
+            assert closure.n_ancestors(color) == len(trace_up(all_bags, bag))
+            assert closure.n_descendants(color) == trace_down(all_bags, bag)
+
+
+def test_closure_export(example_rules_1):
+    closure = BagClosure(get_bags_from_rules(example_rules_1))
+    table = closure.to_dict()
+    assert table["shiny gold"] == {"n_ancestors": 4, "n_descendants": 32}
+    assert closure.ancestors("shiny gold") == {
+        "bright white",
+        "muted yellow",
+        "dark orange",
+        "light red",
+    }
+
+
+def test_graph_updates(example_rules_1):
+    graph = BagGraph(example_rules_1)
+    assert graph.n_ancestors("shiny gold") == 4
+    assert graph.n_descendants("shiny gold") == 32
+
+    # shiny gold bags now hold only faded blue bags
+    graph.replace_rule("shiny gold bags contain 2 faded blue bags.")
+    assert graph.n_descendants("shiny gold") == 2
+    assert graph.n_descendants("bright white") == 3
+    assert graph.n_ancestors("dark olive") == 0
+    assert graph.n_ancestors("faded blue") == 7
+
+    # a new outermost bag, with a forward reference to a not-yet-defined bag
+    graph.add_rule("pale teal bags contain 1 light red bag, 3 wavy cyan bags.")
+    assert graph.n_ancestors("shiny gold") == 5
+    assert graph.undefined == {"wavy cyan"}
+    graph.add_rule("wavy cyan bags contain 1 faded blue bag.")
+    assert graph.n_descendants("pale teal") == 43
+    assert graph.undefined == set()
+
+    graph.remove_rule("pale teal")
+    assert graph.n_ancestors("shiny gold") == 4
+    assert graph.n_ancestors("wavy cyan") == 0
+
+    # matches a graph built from scratch
+    all_bags = get_bags_from_rules(graph.rules())
+    for color, bag in all_bags.items():
+        assert graph.n_ancestors(color) == len(trace_up(all_bags, bag))
+        assert graph.n_descendants(color) == trace_down(all_bags, bag)
+
+
+def test_load_bags(tmp_path, example_rules_1):
+    rules = list(example_rules_1)
+    rules.insert(2, "shiny gold bags hold 3 faded blue bags.")
+    rules.append("dotted black bags contain no other bags.")
+    rules.append("pale teal bags contain 1 wavy cyan bag, 2 wavy cyan bags.")
+    input_path = tmp_path / "rules.txt"
+    input_path.write_text("\n".join(rules) + "\n")
+
+    expected_bags = get_bags_from_rules(example_rules_1)
+    expected_errors = [3, 12, 13, 13]
+    for n_workers in [1, 2]:
+        all_bags, errors = load_bags(input_path, n_workers=n_workers, chunk_size=64)
+        assert [line_number for line_number, _ in errors] == expected_errors
+        del all_bags["pale teal"], all_bags["wavy cyan"]
+        assert {c: b.can_hold for c, b in all_bags.items()} == {
+            c: b.can_hold for c, b in expected_bags.items()
+        }
+        assert {c: b.held_by for c, b in all_bags.items()} == {
+            c: b.held_by for c, b in expected_bags.items()
+        }
+
+
 class Bag:
     def __init__(self, color=""):
         # something like a linked list element
@@ -156,6 +236,157 @@ def get_bags_from_rules(rules_list: list) -> list:
     return all_bags
 
 
+# a bag color is one or more lower-case words
+RULE_PATTERN = re.compile(
+    r"([a-z]+(?: [a-z]+)*?) bags contain "
+    r"(no other bags|\d+ [a-z]+(?: [a-z]+)*? bags?(?:, \d+ [a-z]+(?: [a-z]+)*? bags?)*)\."
+)
+CONTENTS_PATTERN = re.compile(r"(\d+) ([a-z]+(?: [a-z]+)*?) bags?(?:, |$)")
+
+# input files at least this large are parsed in parallel by default
+PARALLEL_MIN_BYTES = 1 << 24
+
+
+def iter_parsed_rules(lines, errors: list, first_line_number: int = 1):
+    """
+    Parse bag rules with one regex match per line, yielding tuples of
+    (line number, holder bag color, [(count, held bag color), ...]).
+
+    Malformed lines are appended to `errors` as (line number, reason)
+    instead of stopping the parse.
+    """
+    match_rule = RULE_PATTERN.fullmatch
+    find_contents = CONTENTS_PATTERN.findall
+    for line_number, line in enumerate(lines, first_line_number):
+        line = line.strip()
+        if not line:
+            continue
+        match = match_rule(line)
+        if match is None:
+            errors.append((line_number, f"Malformed rule: {line}"))
+            continue
+        holder_color, contents = match.groups()
+        if contents == "no other bags":
+            yield line_number, holder_color, []
+        else:
+            yield line_number, holder_color, find_contents(contents)
+
+
+def build_bags(parsed_rules, errors: list) -> dict:
+    """
+    Build the dict of `Bag` objects from the output of `iter_parsed_rules`,
+    filling both the `can_hold` and `held_by` sides as the rules stream in.
+    Bag colors are interned, since each one appears in many rules.
+
+    Inconsistent rules are appended to `errors` as (line number, reason).
+    """
+    intern = sys.intern
+    all_bags = {}
+    defined = set()
+    first_held_at = {}
+    for line_number, holder_color, contents in parsed_rules:
+        holder_color = intern(holder_color)
+        if holder_color in defined:
+            errors.append((line_number, f"Bag {holder_color} already has a rule"))
+            continue
+        defined.add(holder_color)
+        holder_bag = all_bags.get(holder_color)
+        if holder_bag is None:
+            holder_bag = all_bags[holder_color] = Bag(holder_color)
+
+        for count, held_color in contents:
+            held_color = intern(held_color)
+            if held_color in holder_bag.can_hold:
+                errors.append(
+                    (line_number, f"Bag {held_color} appears twice in {holder_color}")
+                )
+                continue
+            holder_bag.can_hold[held_color] = int(count)
+            held_bag = all_bags.get(held_color)
+            if held_bag is None:
+                held_bag = all_bags[held_color] = Bag(held_color)
+                first_held_at[held_color] = line_number
+            held_bag.held_by.add(holder_color)
+
+    for color, line_number in first_held_at.items():
+        if color not in defined:
+            errors.append((line_number, f"Held bag {color} has no rule"))
+    errors.sort(key=lambda error: error[0])
+    return all_bags
+
+
+def read_rule_chunks(input_path, chunk_size: int):
+    """
+    Generator over blocks of roughly `chunk_size` bytes of the input file,
+    each ending on a line boundary, along with the line number of the first
+    line in each block.
+    """
+    with open(input_path, "rb") as ifile:
+        first_line_number = 1
+        while True:
+            data = ifile.read(chunk_size)
+            if not data:
+                break
+            data += ifile.readline()
+            yield first_line_number, data
+            first_line_number += data.count(b"\n")
+
+
+def parse_rule_chunk(chunk) -> tuple:
+    first_line_number, data = chunk
+    errors = []
+    lines = data.decode().split("\n")
+    with paused_gc():
+        parsed = list(iter_parsed_rules(lines, errors, first_line_number))
+    return parsed, errors
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """
+    Building the bags allocates millions of small objects that are never
+    garbage, so the cyclic garbage collector only slows it down.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def load_bags(input_path, n_workers: int = None, chunk_size: int = 1 << 22) -> tuple:
+    """
+    Load the bag rules from the file at `input_path`.
+
+    Returns the dict of `Bag` objects and the list of (line number, reason)
+    errors found along the way. Files larger than `PARALLEL_MIN_BYTES` are
+    split into blocks of `chunk_size` bytes that are parsed by `n_workers`
+    processes (by default, one per CPU), and merged in order.
+    """
+    if n_workers is None:
+        is_large = Path(input_path).stat().st_size >= PARALLEL_MIN_BYTES
+        n_workers = os.cpu_count() if is_large else 1
+
+    errors = []
+    if n_workers <= 1:
+        with open(input_path, "r") as ifile, paused_gc():
+            all_bags = build_bags(iter_parsed_rules(ifile, errors), errors)
+        return all_bags, errors
+
+    with multiprocessing.Pool(n_workers) as pool, paused_gc():
+
+        def parsed_rules():
+            chunks = read_rule_chunks(input_path, chunk_size)
+            for parsed, chunk_errors in pool.imap(parse_rule_chunk, chunks):
+                errors.extend(chunk_errors)
+                yield from parsed
+
+        all_bags = build_bags(parsed_rules(), errors)
+    return all_bags, errors
+
+
 def trace_up(all_bags, bag):
     """
     For the input bag "bag", trace the path upwards along all of its parents,
@@ -191,10 +422,290 @@ def trace_down(all_bags, bag):
     return n
 
 
+def topological_order(all_bags: dict) -> list:
+    """
+    Order the bag colors such that every bag appears before all of the
+    bags that it can hold (Kahn's algorithm).
+    """
+    n_holders = {color: len(bag.held_by) for color, bag in all_bags.items()}
+    order = [color for color, n in n_holders.items() if n == 0]
+    for color in order:  # `order` grows as we go
+        for held_bag_type in all_bags[color].can_hold:
+            n_holders[held_bag_type] -= 1
+            if n_holders[held_bag_type] == 0:
+                order.append(held_bag_type)
+    if len(order) != len(all_bags):
+        print("ERROR: Bag rules contain a cycle, cannot order them!")
+        sys.exit(1)
+    return order
+
+
+class BagClosure:
+    """
+    The number of ancestors (bags that can eventually hold a bag) and
+    descendants (bags that a bag must eventually contain) for every bag
+    color, computed in one pass over the topologically sorted rules.
+
+    Ancestors are kept as bitsets (python ints, one bit per color) so that
+    the ancestors of a bag are just the union of its holders' ancestors.
+    """
+
+    def __init__(self, all_bags: dict):
+        self.order = topological_order(all_bags)
+        self.index = {color: i for i, color in enumerate(self.order)}
+
+        # holders come first, so their ancestor sets are complete by the
+        # time we reach any of the bags that they hold
+        self.ancestor_bits = {}
+        for color in self.order:
+            bits = 0
+            for holder in all_bags[color].held_by:
+                bits |= self.ancestor_bits[holder] | (1 << self.index[holder])
+            self.ancestor_bits[color] = bits
+
+        # held bags come first when walking the order backwards
+        self.descendant_counts = {}
+        for color in reversed(self.order):
+            self.descendant_counts[color] = sum(
+                count * (1 + self.descendant_counts[held_bag_type])
+                for held_bag_type, count in all_bags[color].can_hold.items()
+            )
+
+        self.ancestor_counts = {
+            color: bin(bits).count("1") for color, bits in self.ancestor_bits.items()
+        }
+
+    def n_ancestors(self, color: str) -> int:
+        return self.ancestor_counts[color]
+
+    def n_descendants(self, color: str) -> int:
+        return self.descendant_counts[color]
+
+    def ancestors(self, color: str) -> set:
+        bits = self.ancestor_bits[color]
+        return {c for c, i in self.index.items() if (bits >> i) & 1}
+
+    def to_dict(self) -> dict:
+        return {
+            color: {
+                "n_ancestors": self.ancestor_counts[color],
+                "n_descendants": self.descendant_counts[color],
+            }
+            for color in self.order
+        }
+
+    def dump(self, output_path):
+        with open(output_path, "w") as ofile:
+            json.dump(self.to_dict(), ofile, indent=2)
+
+
+class BagGraph:
+    """
+    A bag rule graph that can be updated one rule at a time.
+
+    Answers to `n_descendants` and `ancestors` are cached per color.
+    Changing the contents of a bag can only change the descendant counts of
+    that bag and the bags above it, and only change the ancestors of the
+    bags that it gained or lost (and everything below those), so only those
+    cache entries are dropped on an update.
+
+    Rules may refer to bags whose own rule has not been added yet. These are
+    kept as empty bags and listed in `undefined` until their rule arrives.
+    """
+
+    def __init__(self, rules_list: list = None):
+        self.bags = {}
+        self.undefined = set()
+        self.descendant_cache = {}
+        self.ancestor_cache = {}
+        for rule in rules_list or []:
+            rule = rule.strip()
+            if not rule:
+                continue
+            self.add_rule(rule)
+
+    def is_defined(self, color: str) -> bool:
+        return color in self.bags and color not in self.undefined
+
+    def add_rule(self, rule: str):
+        holder_bag = get_bag_from_rule(rule)
+        if self.is_defined(holder_bag.color):
+            print(f"ERROR: Bag {holder_bag.color} already has a rule, cannot add it")
+            sys.exit(1)
+        self.set_contents(holder_bag.color, holder_bag.can_hold)
+
+    def replace_rule(self, rule: str):
+        holder_bag = get_bag_from_rule(rule)
+        if not self.is_defined(holder_bag.color):
+            print(f"ERROR: Bag {holder_bag.color} has no rule, cannot replace it")
+            sys.exit(1)
+        self.set_contents(holder_bag.color, holder_bag.can_hold)
+
+    def remove_rule(self, color: str):
+        """
+        Remove the rule for bag `color`. If other bags still hold it, the
+        bag stays in the graph as an undefined (empty) bag.
+        """
+        if not self.is_defined(color):
+            print(f"ERROR: Bag {color} has no rule, cannot remove it")
+            sys.exit(1)
+        self.set_contents(color, {})
+        self.undefined.add(color)
+        self.drop_if_unused(color)
+
+    def set_contents(self, color: str, can_hold: dict):
+        if color not in self.bags:
+            self.bags[color] = Bag(color)
+        bag = self.bags[color]
+        self.undefined.discard(color)
+
+        old_can_hold = bag.can_hold
+        changed = [
+            c
+            for c in set(old_can_hold) | set(can_hold)
+            if old_can_hold.get(c) != can_hold.get(c)
+        ]
+        gained_or_lost = [c for c in changed if (c in old_can_hold) != (c in can_hold)]
+
+        # bags that are no longer held by this one lose it (and its
+        # ancestors) as ancestors, so invalidate before unlinking them
+        for held_bag_type in gained_or_lost:
+            self.invalidate_ancestors(held_bag_type)
+
+        for held_bag_type in old_can_hold:
+            if held_bag_type not in can_hold:
+                self.bags[held_bag_type].held_by.discard(color)
+                self.drop_if_unused(held_bag_type)
+        for held_bag_type in can_hold:
+            if held_bag_type not in self.bags:
+                self.bags[held_bag_type] = Bag(held_bag_type)
+                self.undefined.add(held_bag_type)
+            self.bags[held_bag_type].held_by.add(color)
+        bag.can_hold = dict(can_hold)
+
+        if changed:
+            self.invalidate_descendants(color)
+
+    def drop_if_unused(self, color: str):
+        """
+        Forget an undefined bag once nothing holds it anymore.
+        """
+        if color in self.undefined and not self.bags[color].held_by:
+            self.undefined.discard(color)
+            self.ancestor_cache.pop(color, None)
+            self.descendant_cache.pop(color, None)
+            del self.bags[color]
+
+    def invalidate_descendants(self, color: str):
+        """
+        Drop the cached descendant counts of `color` and all of its ancestors.
+
+        A bag's count is only cached once all of the bags below it are, so
+        the walk can stop at any bag that has nothing cached. The same holds
+        for the ancestor sets going the other way.
+        """
+        to_visit = [color]
+        while to_visit:
+            c = to_visit.pop()
+            if self.descendant_cache.pop(c, None) is None:
+                continue
+            to_visit.extend(self.bags[c].held_by)
+
+    def invalidate_ancestors(self, color: str):
+        """
+        Drop the cached ancestor sets of `color` and all of its descendants.
+        """
+        to_visit = [color]
+        while to_visit:
+            c = to_visit.pop()
+            if self.ancestor_cache.pop(c, None) is None:
+                continue
+            to_visit.extend(self.bags[c].can_hold)
+
+    def n_descendants(self, color: str) -> int:
+        cache = self.descendant_cache
+        if color in cache:
+            return cache[color]
+
+        # iterative post-order walk, so that long chains of bags do not
+        # hit the recursion limit
+        to_visit = [(color, False)]
+        on_path = set()
+        while to_visit:
+            c, children_done = to_visit.pop()
+            if c in cache:
+                continue
+            can_hold = self.bags[c].can_hold
+            if children_done:
+                on_path.discard(c)
+                cache[c] = sum(
+                    count * (1 + cache[held_bag_type])
+                    for held_bag_type, count in can_hold.items()
+                )
+                continue
+            if c in on_path:
+                print(f"ERROR: Bag rules contain a cycle through bag {c}!")
+                sys.exit(1)
+            on_path.add(c)
+            to_visit.append((c, True))
+            to_visit.extend((h, False) for h in can_hold if h not in cache)
+        return cache[color]
+
+    def ancestors(self, color: str) -> frozenset:
+        cache = self.ancestor_cache
+        if color in cache:
+            return cache[color]
+
+        to_visit = [(color, False)]
+        on_path = set()
+        while to_visit:
+            c, parents_done = to_visit.pop()
+            if c in cache:
+                continue
+            held_by = self.bags[c].held_by
+            if parents_done:
+                on_path.discard(c)
+                parents = set(held_by)
+                for holder in held_by:
+                    parents |= cache[holder]
+                cache[c] = frozenset(parents)
+                continue
+            if c in on_path:
+                print(f"ERROR: Bag rules contain a cycle through bag {c}!")
+                sys.exit(1)
+            on_path.add(c)
+            to_visit.append((c, True))
+            to_visit.extend((h, False) for h in held_by if h not in cache)
+        return cache[color]
+
+    def n_ancestors(self, color: str) -> int:
+        return len(self.ancestors(color))
+
+    def rules(self) -> list:
+        """
+        The current rules, in the same format as the puzzle input.
+        """
+        rules = []
+        for color, bag in self.bags.items():
+            if color in self.undefined:
+                continue
+            if not bag.can_hold:
+                rules.append(f"{color} bags contain no other bags.")
+                continue
+            contents = ", ".join(
+                f"{count} {held_bag_type} bag{'s' if count > 1 else ''}"
+                for held_bag_type, count in bag.can_hold.items()
+            )
+            rules.append(f"{color} bags contain {contents}.")
+        return rules
+
+
 def main(input_path):
-    with open(input_path, "r") as infile:
-        all_rules = infile.readlines()
-    all_bags = get_bags_from_rules(all_rules)
+    all_bags, errors = load_bags(input_path)
+    if errors:
+        for line_number, reason in errors:
+            print(f"ERROR: line {line_number}: {reason}")
+        sys.exit(1)
     print(f"Found {len(all_bags)} bag types")
 
     # part 1
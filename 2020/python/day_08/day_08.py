@@ -9,6 +9,14 @@
 #
 
 import sys
+import os
+import mmap
+import time
+import json
+import struct
+import collections
+import multiprocessing
+from array import array
 from argparse import ArgumentParser
 from pathlib import Path
 
@@ -164,45 +172,270 @@ def test_corruption_fix():
     assert program.finished
 
 
+def test_corrupted_nop():
+    program_lines = ["nop +2", "jmp +0", "acc +1"]
+    assert find_corrupted_instruction(program_lines) == ["nop", 0]
+
+
+def test_terminating_instructions(example_instructions_infinite_loop):
+    program = CompiledProgram.from_lines(example_instructions_infinite_loop)
+    assert list(find_terminating_instructions(program)) == [0] * 8 + [1]
+
+
+def test_compiled_program(example_instructions_infinite_loop):
+    program = CompiledProgram.from_lines(example_instructions_infinite_loop)
+    assert program.instruction(2) == ["jmp", 4]
+    assert list(program.opcodes) == [
+        OP_NOP,
+        OP_ACC,
+        OP_JMP,
+        OP_ACC,
+        OP_JMP,
+        OP_ACC,
+        OP_ACC,
+        OP_JMP,
+        OP_ACC,
+    ]
+    assert program.run_until_loop_or_halt() == (5, 1, LOOPED)
+
+    # flip the corrupted instruction, see `test_corruption_fix`
+    program.opcodes[7] = OP_NOP
+    assert program.run_until_loop_or_halt() == (8, 9, HALTED)
+
+
+def test_compiled_matches_program(example_instructions_infinite_loop):
+    program = Program(example_instructions_infinite_loop)
+    for istep, _ in enumerate(program):
+        if program.counts[program.sp] >= 1:
+            break
+    compiled = program.compile()
+    assert compiled.run_until_loop_or_halt() == (
+        program.accumulator,
+        program.sp,
+        LOOPED,
+    )
+
+
+def test_compiled_bad_jump():
+    program = CompiledProgram.from_lines(["acc +3", "jmp -2"])
+    assert program.run_until_loop_or_halt() == (3, -1, OUT_OF_BOUNDS)
+
+
+def test_trace(example_instructions_infinite_loop, tmp_path):
+    program = CompiledProgram.from_lines(example_instructions_infinite_loop)
+    trace = ExecutionTrace(len(program), ring_size=3)
+    assert program.run_traced(trace) == program.run_until_loop_or_halt()
+    assert list(trace.hits) == [1, 1, 1, 1, 1, 0, 1, 1, 0]
+    assert (trace.loop_entry, trace.loop_exit) == (1, 4)
+    assert trace.back_edges == {(4, 1): 1, (7, 3): 1}
+    assert list(trace.ring) == [(7, OP_JMP, 2), (3, OP_ACC, 5), (4, OP_JMP, 5)]
+
+    trace = ExecutionTrace(len(program), ring_size=3)
+    assert program.run_traced(trace, max_steps=20) == (16, 2, STEP_LIMIT)
+    assert trace.n_steps == 20
+    assert trace.hot_blocks(program, n_top=1) == [(1, 3, 7)]
+
+    trace.to_json(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json", "r") as ifile:
+        assert json.load(ifile)["hits"] == list(trace.hits)
+    trace.dump(tmp_path / "trace.bin")
+    loaded = ExecutionTrace.load(tmp_path / "trace.bin")
+    assert list(loaded.hits) == list(trace.hits)
+    assert list(loaded.ring) == list(trace.ring)
+    assert loaded.back_edges == trace.back_edges
+
+
+def test_unwind_restores_state(example_instructions_infinite_loop):
+    program = Program(example_instructions_infinite_loop)
+    for istep, _ in enumerate(program):
+        if program.counts[program.sp] >= 1:
+            break
+    program.unwind()
+    assert (program.sp, program.accumulator, program.counts[4]) == (4, 5, 0)
+
+
+def test_history_fork(example_instructions_infinite_loop):
+    program = CompiledProgram.from_lines(example_instructions_infinite_loop)
+    history = ExecutionHistory(program)
+    assert list(history.path) == [0, 1, 2, 6, 7, 3, 4]
+    assert history.result == (5, 1, LOOPED)
+
+    snapshot = history.snapshot(7)
+    assert (snapshot.sp, snapshot.accumulator, snapshot.n_steps) == (7, 2, 4)
+    assert history.snapshot(5) is None
+    assert history.resume(snapshot) == history.result
+    assert history.resume(snapshot, {7: OP_NOP}) == (8, 9, HALTED)
+    assert history.resume(history.snapshot(0), {0: OP_JMP}) == (0, 0, LOOPED)
+
+    # the program itself is left untouched
+    assert program.opcodes[7] == OP_JMP
+    assert find_repair_by_forking(program) == (7, 8)
+
+
+def test_find_patches(example_instructions_infinite_loop):
+    program = CompiledProgram.from_lines(example_instructions_infinite_loop)
+    assert find_patches(program, max_patches=1) == ({7: OP_NOP}, 8)
+
+    # needs both jmp +0 instructions to be patched
+    program = CompiledProgram.from_lines(["jmp +0", "jmp +0", "acc +1"])
+    assert find_patches(program, max_patches=1) is None
+    assert find_patches(program, max_patches=2) == ({0: OP_NOP, 1: OP_NOP}, 1)
+
+    # needs an acc to become a jmp, along with a nop to become a jmp
+    program_lines = ["nop +3", "acc +1", "jmp -2", "acc +4", "jmp -1", "acc +1"]
+    program = CompiledProgram.from_lines(program_lines)
+    assert find_patches(program) == ({0: OP_JMP, 3: OP_JMP}, 0)
+
+    # in parallel, any of the valid configurations can come back first
+    progress = []
+    patches, accumulator = find_patches(program, n_workers=2, report=progress.append)
+    assert list(program.opcodes) == [OP_NOP, OP_ACC, OP_JMP, OP_ACC, OP_JMP, OP_ACC]
+    assert progress[-1]["n_tasks_done"] <= progress[-1]["n_tasks"]
+    for location, op in patches.items():
+        program.opcodes[location] = op
+    assert program.run_until_loop_or_halt()[::2] == (accumulator, HALTED)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_find_patches_does_not_repatch(n_workers):
+    # a deeper patch must not undo (or overwrite) one made further up
+    program_lines = ["nop -3", "jmp -3", "jmp +3", "jmp +2"]
+    program = CompiledProgram.from_lines(program_lines)
+    found = find_patches(program, max_patches=3, n_workers=n_workers)
+    assert found is not None
+    patches, accumulator = found
+    assert len(patches) <= 3
+    for location, op in patches.items():
+        program.opcodes[location] = op
+    assert program.run_until_loop_or_halt()[::2] == (accumulator, HALTED)
+
+
+def test_program_image(example_instructions_infinite_loop, tmp_path):
+    input_path = tmp_path / "program.txt"
+    input_path.write_text("\n".join(example_instructions_infinite_loop))
+    program = load_program(input_path)
+    image_path = tmp_path / ("program.txt" + IMAGE_SUFFIX)
+    assert image_path.exists()
+
+    cached = load_program(input_path)
+    assert isinstance(cached.opcodes, memoryview)
+    assert list(cached.opcodes) == list(program.opcodes)
+    assert list(cached.arguments) == list(program.arguments)
+    assert find_repair_location(cached) == 7
+
+    # patching the loaded program leaves the image alone
+    cached.opcodes[7] = OP_NOP
+    assert cached.run_until_loop_or_halt() == (8, 9, HALTED)
+    assert list(load_program(input_path).opcodes) == list(program.opcodes)
+
+    # the image is rebuilt when the text changes
+    input_path.write_text("acc +7\nacc -2\n")
+    assert load_program(input_path).run_until_loop_or_halt() == (5, 2, HALTED)
+
+
+@pytest.mark.parametrize("image_size", [0, 10, 30])
+def test_program_image_rebuilt(
+    example_instructions_infinite_loop, tmp_path, image_size
+):
+    input_path = tmp_path / "program.txt"
+    input_path.write_text("\n".join(example_instructions_infinite_loop))
+    image_path = tmp_path / ("program.txt" + IMAGE_SUFFIX)
+    load_program(input_path)
+    full_size = image_path.stat().st_size
+
+    # a truncated (or otherwise invalid) image is a cache miss, not an error
+    with open(image_path, "r+b") as ofile:
+        ofile.truncate(image_size)
+    with pytest.raises(ImageError):
+        CompiledProgram.load_image(image_path)
+    assert find_repair_location(load_program(input_path)) == 7
+    assert image_path.stat().st_size == full_size
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "program.txt",
+        "program.txt" + IMAGE_SUFFIX,
+    ]
+
+
 def find_corrupted_instruction(program_lines):
+    """
+    Find the single jmp (or nop) instruction that, when flipped to a
+    nop (or jmp), makes the program terminate.
 
-    # brute force!
-    jmp_locations = []
-    nop_locations = []
-    program = Program(program_lines)
-    for istep, instruction in enumerate(program.program):
-        instruction, action = instruction
-        if instruction == "jmp":
-            jmp_locations.append(istep)
-        elif instruction == "nop":
-            nop_locations.append(istep)
-
-    program_finished = False
-    max_step = 0
-    max_sp = 0
-    max_sp_at = ["", 0]
-
-    for iop, op_locations in enumerate([jmp_locations, nop_locations]):
-        for location in op_locations:
-            program = Program(program_lines)
-            current_instruction = program.program[location]
-            new_instruction = {0: "nop", 1: "jmp"}[iop]
-            new_instruction = [new_instruction, current_instruction[1]]
-            program.program[location] = new_instruction
-            for istep, _ in enumerate(program):
-                max_step = max([istep, max_step])
-                if program.sp > max_sp:
-                    max_sp = max([max_sp, program.sp])
-                    max_sp_at = [{0: "jmp", 1: "nop"}[iop], location]
-                max_sp = max([max_sp, program.sp])
-                if program.counts[program.sp] >= 1:
-                    break
-            if program.finished:
-                program_finished = True
-    if program_finished:
-        return max_sp_at
-    else:
+    Returns the [instruction, location] of the corrupted instruction, or
+    None if no single flip makes the program terminate.
+    """
+    program = CompiledProgram.from_lines(program_lines)
+    location = find_repair_location(program)
+    if location is None:
         return None
+    return [program.instruction(location)[0], location]
+
+
+def find_terminating_instructions(program) -> bytearray:
+    """
+    Mark every instruction from which the (unmodified) program runs off
+    of the end, by walking the reversed control flow graph backwards from
+    the end of the program.
+    """
+    opcodes = program.opcodes
+    arguments = program.arguments
+    n_instructions = len(opcodes)
+
+    # the extra entry at `n_instructions` collects every instruction that
+    # jumps or steps past the last instruction
+    predecessors = [[] for _ in range(n_instructions + 1)]
+    for sp in range(n_instructions):
+        target = sp + arguments[sp] if opcodes[sp] == OP_JMP else sp + 1
+        if target >= n_instructions:
+            predecessors[n_instructions].append(sp)
+        elif target >= 0:
+            predecessors[target].append(sp)
+
+    terminates = bytearray(n_instructions + 1)
+    terminates[n_instructions] = 1
+    to_visit = [n_instructions]
+    while to_visit:
+        for sp in predecessors[to_visit.pop()]:
+            if not terminates[sp]:
+                terminates[sp] = 1
+                to_visit.append(sp)
+    del terminates[n_instructions]
+    return terminates
+
+
+def find_repair_location(program):
+    """
+    Find the location of the first jmp or nop instruction on the original
+    execution path that, once flipped, leads into the set of terminating
+    instructions. This is O(N) in the size of the program.
+
+    Flipping an instruction only changes where the program goes next, and
+    the instructions that follow (which were not on the original path,
+    or they would already terminate) run unmodified, so it is enough to
+    check the alternative target of each instruction on the original path.
+    """
+    terminates = find_terminating_instructions(program)
+    opcodes = program.opcodes
+    arguments = program.arguments
+    n_instructions = len(opcodes)
+    visited = bytearray(n_instructions)
+    sp = 0
+    while 0 <= sp < n_instructions and not visited[sp]:
+        visited[sp] = 1
+        op = opcodes[sp]
+        if op == OP_ACC:
+            sp += 1
+            continue
+        if op == OP_JMP:
+            next_sp, alternative_sp = sp + arguments[sp], sp + 1
+        else:
+            next_sp, alternative_sp = sp + 1, sp + arguments[sp]
+        if alternative_sp >= n_instructions or (
+            alternative_sp >= 0 and terminates[alternative_sp]
+        ):
+            return sp
+        sp = next_sp
+    return None
 
 
 class Program:
@@ -212,9 +445,8 @@ class Program:
         self.sp = 0
         self.counts = []
 
-        self.previous_sp = 0
+        self.previous_sp = None
         self.previous_accumulator = 0
-        self.previous_counts = []
 
         self.program = []
         self.started = False
@@ -222,9 +454,23 @@ class Program:
         self.load_program(program_lines)
 
     def unwind(self):
+        """
+        Roll back the last executed instruction. Only a single step is kept,
+        use `ExecutionHistory` to go back further.
+        """
+        if self.previous_sp is None:
+            return
+        self.counts[self.previous_sp] -= 1
         self.sp = self.previous_sp
         self.accumulator = self.previous_accumulator
-        self.counts = self.previous_counts
+        self.previous_sp = None
+        self.finished = False
+
+    def compile(self):
+        return CompiledProgram(
+            array("b", [OPCODES[instruction] for instruction, _ in self.program]),
+            array("i", [action for _, action in self.program]),
+        )
 
     def __str__(self):
         if self.sp >= len(self.program):
@@ -242,7 +488,6 @@ class Program:
         instruction, action = self.program[self.sp]
         self.previous_sp = self.sp
         self.previous_accumulator = self.accumulator
-        self.previous_counts = self.counts
         if instruction == "acc":
             self.accumulator += action
 
@@ -297,56 +542,892 @@ class Program:
             program_line += 1
 
 
-def main(input_path):
+# opcodes of the compiled program
+OP_ACC, OP_JMP, OP_NOP = 0, 1, 2
+OPCODES = {"acc": OP_ACC, "jmp": OP_JMP, "nop": OP_NOP}
+OPCODE_NAMES = {code: name for name, code in OPCODES.items()}
+FLIPPED_OPCODES = {OP_JMP: OP_NOP, OP_NOP: OP_JMP}
+
+# reasons for a compiled program to stop running
+HALTED = "halted"  # stepped past the last instruction
+LOOPED = "looped"  # about to execute an instruction for the second time
+OUT_OF_BOUNDS = "out of bounds"  # jumped to before the first instruction
+STEP_LIMIT = "step limit"  # ran the maximum number of steps (traced runs only)
+
+
+# binary program image header: magic, version, number of instructions, and
+# the size and mtime (in ns) of the text file that the image was built from
+IMAGE_HEADER = struct.Struct("<4sHxxIqq")
+IMAGE_MAGIC = b"HHPI"
+IMAGE_VERSION = 1
+IMAGE_SUFFIX = ".img"
+
+
+class ImageError(ValueError):
+    """
+    Raised when a file is not a valid program image, e.g. it was truncated
+    or written by a different version of this script.
+    """
+
+
+def image_padding(n_instructions: int) -> int:
+    """
+    Number of padding bytes after the opcodes, so that the int32
+    arguments are 4-byte aligned.
+    """
+    return -(IMAGE_HEADER.size + n_instructions) % 4
+
+
+def load_program(input_path):
+    """
+    Load the program in the text file at `input_path` as a `CompiledProgram`.
+
+    The compiled program is cached as a binary image next to the text file
+    (with `IMAGE_SUFFIX` appended to the name), and later loads map the
+    image directly as long as the text file has not changed since. An
+    image that cannot be read is treated like a stale one and rebuilt.
+    """
+    input_path = Path(input_path)
+    image_path = input_path.with_name(input_path.name + IMAGE_SUFFIX)
+    source = input_path.stat()
+    if image_path.exists():
+        try:
+            program, source_size, source_mtime = CompiledProgram.load_image(image_path)
+        except ImageError:
+            pass
+        else:
+            if (source_size, source_mtime) == (source.st_size, source.st_mtime_ns):
+                return program
 
     with open(input_path, "r") as ifile:
-        program_lines = [line.strip() for line in ifile.readlines() if line != ""]
-    program = Program(program_lines)
+        program = CompiledProgram.from_lines(ifile)
+    try:
+        program.save(image_path, source.st_size, source.st_mtime_ns)
+    except OSError as error:
+        print(f"WARNING: Could not cache program image {image_path}: {error}")
+    return program
+
+
+class CompiledProgram:
+    """
+    A program stored as a flat array of integer opcodes and a flat array
+    of arguments, run by a single loop over local variables rather than
+    stepping through `Program.__next__`.
+    """
+
+    def __init__(self, opcodes, arguments):
+        self.opcodes = opcodes
+        self.arguments = arguments
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    @classmethod
+    def from_lines(cls, program_lines):
+        opcodes = array("b")
+        arguments = array("i")
+        for line in program_lines:
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != 2 or fields[0] not in OPCODES:
+                print(f"ERROR: Invalid formed instruction: {line.strip()}")
+                sys.exit(1)
+            opcodes.append(OPCODES[fields[0]])
+            arguments.append(int(fields[1]))
+        return cls(opcodes, arguments)
+
+    def instruction(self, sp: int) -> list:
+        return [OPCODE_NAMES[self.opcodes[sp]], self.arguments[sp]]
+
+    def save(self, output_path, source_size: int = 0, source_mtime: int = 0):
+        """
+        Write the program as a binary image (see `IMAGE_HEADER`): the header,
+        the int8 opcodes, padding up to a multiple of 4 bytes, and the
+        little-endian int32 arguments. `source_size` and `source_mtime` (in
+        ns) identify the text file that the image was compiled from.
+
+        The image is written to a temporary file next to `output_path` and
+        then renamed into place, so readers never see a partly written image.
+        """
+        output_path = Path(output_path)
+        partial_path = output_path.with_name(
+            f"{output_path.name}.{os.getpid()}.partial"
+        )
+        n_instructions = len(self.opcodes)
+        arguments = array("i", self.arguments)
+        if sys.byteorder != "little":
+            arguments.byteswap()
+        try:
+            with open(partial_path, "wb") as ofile:
+                ofile.write(
+                    IMAGE_HEADER.pack(
+                        IMAGE_MAGIC,
+                        IMAGE_VERSION,
+                        n_instructions,
+                        source_size,
+                        source_mtime,
+                    )
+                )
+                ofile.write(array("b", self.opcodes).tobytes())
+                ofile.write(bytes(image_padding(n_instructions)))
+                arguments.tofile(ofile)
+            os.replace(partial_path, output_path)
+        except BaseException:
+            if partial_path.exists():
+                partial_path.unlink()
+            raise
+
+    @classmethod
+    def load_image(cls, input_path):
+        """
+        Load a program saved with `save`, without copying: the opcode and
+        argument arrays are views into a (copy-on-write) memory map of the
+        file, so patching the program does not modify the image on disk.
+
+        Returns the program, along with the source size and mtime stored in
+        the header. Raises `ImageError` if the file is not a complete image.
+        """
+        with open(input_path, "rb") as ifile:
+            if os.fstat(ifile.fileno()).st_size < IMAGE_HEADER.size:
+                raise ImageError(f"{input_path} is not a program image")
+            image = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_COPY)
+        (
+            magic,
+            version,
+            n_instructions,
+            source_size,
+            source_mtime,
+        ) = IMAGE_HEADER.unpack_from(image)
+        opcodes_start = IMAGE_HEADER.size
+        arguments_start = opcodes_start + n_instructions + image_padding(n_instructions)
+        image_size = arguments_start + 4 * n_instructions
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION or len(image) != image_size:
+            image.close()
+            raise ImageError(f"{input_path} is not a program image")
+
+        view = memoryview(image)
+        opcodes_end = opcodes_start + n_instructions
+        opcodes = view[opcodes_start:opcodes_end].cast("b")
+        arguments = view[arguments_start:image_size]
+        if sys.byteorder == "little":
+            arguments = arguments.cast("i")
+        else:
+            arguments = array("i", arguments.tobytes())
+            arguments.byteswap()
+        return cls(opcodes, arguments), source_size, source_mtime
+
+    def run_until_loop_or_halt(self, sp: int = 0, accumulator: int = 0) -> tuple:
+        """
+        Run the program starting at instruction `sp` until it is either about
+        to repeat an instruction or it leaves the program.
+
+        Returns the accumulator, the final SP and the reason for stopping
+        (one of HALTED, LOOPED, OUT_OF_BOUNDS).
+        """
+        opcodes = self.opcodes
+        arguments = self.arguments
+        n_instructions = len(opcodes)
+        visited = bytearray(n_instructions)
+        while 0 <= sp < n_instructions:
+            if visited[sp]:
+                return accumulator, sp, LOOPED
+            visited[sp] = 1
+            op = opcodes[sp]
+            if op == OP_JMP:
+                sp += arguments[sp]
+            else:
+                if op == OP_ACC:
+                    accumulator += arguments[sp]
+                sp += 1
+        return accumulator, sp, HALTED if sp >= n_instructions else OUT_OF_BOUNDS
+
+    def run_traced(
+        self, trace, sp: int = 0, accumulator: int = 0, max_steps: int = None
+    ) -> tuple:
+        """
+        Same as `run_until_loop_or_halt`, but records every step in the
+        `ExecutionTrace` object `trace`.
+
+        If `max_steps` is given, loop detection is turned off and the program
+        runs for at most `max_steps` instructions, so that the hit counts
+        show where a looping program spends its time.
+
+        This is a separate copy of the run loop so that untraced runs do not
+        pay for any of the bookkeeping.
+        """
+        opcodes = self.opcodes
+        arguments = self.arguments
+        n_instructions = len(opcodes)
+        hits = trace.hits
+        back_edges = trace.back_edges
+        record_state = trace.ring.append
+        detect_loop = max_steps is None
+        visited = bytearray(n_instructions)
+        n_steps = 0
+        last_sp = -1
+        reason = None
+        while 0 <= sp < n_instructions:
+            if detect_loop:
+                if visited[sp]:
+                    trace.loop_entry, trace.loop_exit = sp, last_sp
+                    reason = LOOPED
+                    break
+                visited[sp] = 1
+            elif n_steps >= max_steps:
+                reason = STEP_LIMIT
+                break
+            n_steps += 1
+            hits[sp] += 1
+            last_sp = sp
+            op = opcodes[sp]
+            if op == OP_JMP:
+                offset = arguments[sp]
+                if offset <= 0:
+                    edge = (sp, sp + offset)
+                    back_edges[edge] = back_edges.get(edge, 0) + 1
+                sp += offset
+            else:
+                if op == OP_ACC:
+                    accumulator += arguments[sp]
+                sp += 1
+            record_state((last_sp, op, accumulator))
+        trace.n_steps += n_steps
+        if reason is None:
+            reason = HALTED if sp >= n_instructions else OUT_OF_BOUNDS
+        return accumulator, sp, reason
+
+
+class Snapshot:
+    """
+    The state of a program at some point of a recorded run: the SP, the
+    accumulator, and the visited instructions. The visited instructions are
+    not copied; they are the first `n_steps` instructions on the `path` of
+    the `ExecutionHistory` that the snapshot was taken from.
+    """
+
+    __slots__ = ("sp", "accumulator", "n_steps")
+
+    def __init__(self, sp: int, accumulator: int, n_steps: int):
+        self.sp = sp
+        self.accumulator = accumulator
+        self.n_steps = n_steps
+
+
+class ExecutionHistory:
+    """
+    A single run of a `CompiledProgram` (until it loops or halts) in which
+    the order of the executed instructions, and the accumulator before each
+    of them, are recorded. Any point of the run can then be restored as a
+    `Snapshot` and resumed, possibly with some instructions patched,
+    without re-running the program from instruction 0.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        opcodes = program.opcodes
+        arguments = program.arguments
+        n_instructions = len(opcodes)
+
+        # step at which each instruction was first executed, with
+        # `n_instructions` meaning never
+        step_of = array("i", [n_instructions]) * n_instructions
+        path = array("i")
+        accumulators = []
+
+        sp = 0
+        accumulator = 0
+        n_steps = 0
+        reason = None
+        while 0 <= sp < n_instructions:
+            if step_of[sp] < n_steps:
+                reason = LOOPED
+                break
+            step_of[sp] = n_steps
+            path.append(sp)
+            accumulators.append(accumulator)
+            n_steps += 1
+            op = opcodes[sp]
+            if op == OP_JMP:
+                sp += arguments[sp]
+            else:
+                if op == OP_ACC:
+                    accumulator += arguments[sp]
+                sp += 1
+        if reason is None:
+            reason = HALTED if sp >= n_instructions else OUT_OF_BOUNDS
+
+        self.step_of = step_of
+        self.path = path
+        self.accumulators = accumulators
+        self.result = (accumulator, sp, reason)
+
+    def snapshot(self, sp: int) -> Snapshot:
+        """
+        The state of the program the first time that it reached instruction
+        `sp`, or None if it never did.
+        """
+        n_steps = self.step_of[sp]
+        if n_steps >= len(self.path):
+            return None
+        return Snapshot(sp, self.accumulators[n_steps], n_steps)
+
+    def resume(self, snapshot: Snapshot, patches: dict = None) -> tuple:
+        """
+        Continue running the program from `snapshot` until it loops or
+        halts, with the opcodes at the locations in `patches` replaced by
+        the given ones. Returns the same as `run_until_loop_or_halt`.
+
+        Instructions visited before the snapshot are looked up in the
+        shared history; only the ones visited after it are tracked (in a
+        set private to this call), so the visited state is copy-on-write.
+        """
+        program = self.program
+        opcodes = program.opcodes
+        arguments = program.arguments
+        n_instructions = len(opcodes)
+        patches = patches or {}
+        original_opcodes = {sp: opcodes[sp] for sp in patches}
+        for location, op in patches.items():
+            opcodes[location] = op
+
+        step_of = self.step_of
+        n_steps = snapshot.n_steps
+        visited = set()
+        sp = snapshot.sp
+        accumulator = snapshot.accumulator
+        try:
+            while 0 <= sp < n_instructions:
+                if step_of[sp] < n_steps or sp in visited:
+                    return accumulator, sp, LOOPED
+                visited.add(sp)
+                op = opcodes[sp]
+                if op == OP_JMP:
+                    sp += arguments[sp]
+                else:
+                    if op == OP_ACC:
+                        accumulator += arguments[sp]
+                    sp += 1
+        finally:
+            for location, op in original_opcodes.items():
+                opcodes[location] = op
+        return accumulator, sp, HALTED if sp >= n_instructions else OUT_OF_BOUNDS
+
+
+def find_repair_by_forking(program) -> tuple:
+    """
+    Try flipping each jmp/nop on the original execution path, resuming
+    from the snapshot taken when the flipped instruction was first reached
+    instead of from instruction 0.
+
+    Returns the location of the flipped instruction and the accumulator
+    of the repaired program, or None if no single flip terminates.
+    """
+    history = ExecutionHistory(program)
+    for sp in history.path:
+        op = program.opcodes[sp]
+        if op == OP_ACC:
+            continue
+        snapshot = history.snapshot(sp)
+        accumulator, _, reason = history.resume(snapshot, {sp: FLIPPED_OPCODES[op]})
+        if reason == HALTED:
+            return sp, accumulator
+    return None
+
+
+# mutations tried by the patch search, for each opcode. A jmp -> acc patch
+# has the same control flow as jmp -> nop, so it is not tried separately
+MUTATIONS = {OP_JMP: (OP_NOP,), OP_NOP: (OP_JMP,), OP_ACC: (OP_JMP,)}
+
+
+def run_recording(program, sp: int, accumulator: int, visited: bytearray) -> tuple:
+    """
+    Run the program from `sp` until it loops or halts, marking the executed
+    instructions in `visited` (in place). Returns the executed path, the
+    accumulator before each step on the path, and the same tuple as
+    `run_until_loop_or_halt`.
+    """
+    opcodes = program.opcodes
+    arguments = program.arguments
+    n_instructions = len(opcodes)
+    path = []
+    accumulators = []
+    while 0 <= sp < n_instructions:
+        if visited[sp]:
+            return path, accumulators, (accumulator, sp, LOOPED)
+        visited[sp] = 1
+        path.append(sp)
+        accumulators.append(accumulator)
+        op = opcodes[sp]
+        if op == OP_JMP:
+            sp += arguments[sp]
+        else:
+            if op == OP_ACC:
+                accumulator += arguments[sp]
+            sp += 1
+    reason = HALTED if sp >= n_instructions else OUT_OF_BOUNDS
+    return path, accumulators, (accumulator, sp, reason)
+
+
+def leads_to_termination(target: int, terminates: bytearray) -> bool:
+    return target >= len(terminates) or (target >= 0 and terminates[target] == 1)
+
+
+def search_patches(
+    program,
+    sp,
+    accumulator,
+    visited,
+    n_remaining,
+    stats,
+    cancelled=None,
+    patched=frozenset(),
+) -> tuple:
+    """
+    Depth-first search for at most `n_remaining` patches, applied from
+    state (sp, accumulator, visited) onwards, that make the program halt.
+
+    Only instructions that are actually reached can matter, so the candidate
+    sites are the instructions on the path run from the current state. For
+    the last patch, candidates whose new target does not lead to the end of
+    the (already patched) program are skipped without running them.
+
+    Patches are written to `program.opcodes` while they are being tried and
+    restored afterwards, and the sites in `patched` (the ones that have
+    already been patched further up the search) are not patched again.
+    `stats` accumulates the number of runs and executed instructions.
+
+    Returns the dict of {location: new opcode} and the final accumulator,
+    or None.
+    """
+    opcodes = program.opcodes
+    arguments = program.arguments
+    visited_so_far = bytearray(visited)
+    path, accumulators, (final_accumulator, _, reason) = run_recording(
+        program, sp, accumulator, visited
+    )
+    stats["n_runs"] += 1
+    stats["n_steps"] += len(path)
+    if reason == HALTED:
+        return {}, final_accumulator
+    if n_remaining == 0 or (cancelled is not None and cancelled.is_set()):
+        return None
+
+    terminates = None
+    if n_remaining == 1:
+        terminates = find_terminating_instructions(program)
+    for site, accumulator in zip(path, accumulators):
+        op = opcodes[site]
+        if site in patched:
+            visited_so_far[site] = 1
+            continue
+        for new_op in MUTATIONS[op]:
+            if terminates is not None:
+                target = site + arguments[site] if new_op == OP_JMP else site + 1
+                if not leads_to_termination(target, terminates):
+                    continue
+            opcodes[site] = new_op
+            try:
+                found = search_patches(
+                    program,
+                    site,
+                    accumulator,
+                    bytearray(visited_so_far),
+                    n_remaining - 1,
+                    stats,
+                    cancelled,
+                    patched | {site},
+                )
+            finally:
+                opcodes[site] = op
+            if found is not None:
+                patches, final_accumulator = found
+                patches[site] = new_op
+                return patches, final_accumulator
+        visited_so_far[site] = 1
+    return None
+
+
+# per-process state of the `find_patches` workers
+worker_state = {}
+
+
+def init_patch_worker(opcodes, arguments, max_patches, cancelled, history=None):
+    program = CompiledProgram(opcodes, arguments)
+    worker_state["program"] = program
+    worker_state["history"] = history or ExecutionHistory(program)
+    worker_state["max_patches"] = max_patches
+    worker_state["cancelled"] = cancelled
+    # the instructions on the original path before step `visited_step`
+    worker_state["visited"] = bytearray(len(program))
+    worker_state["visited_step"] = 0
+
+
+def visited_before(step: int) -> bytearray:
+    """
+    A copy of the instructions on the original path before `step`, marked
+    as visited. The tasks come in (roughly) increasing order of step, so
+    the worker keeps one such array and moves it forwards along the path,
+    rather than marking the whole prefix again for every task.
+    """
+    history = worker_state["history"]
+    visited = worker_state["visited"]
+    if step < worker_state["visited_step"]:
+        visited = worker_state["visited"] = bytearray(len(visited))
+        worker_state["visited_step"] = 0
+    start = worker_state["visited_step"]
+    for sp in history.path[start:step]:
+        visited[sp] = 1
+    worker_state["visited_step"] = step
+    return bytearray(visited)
+
+
+def run_patch_task(task) -> tuple:
+    """
+    Search for the remaining patches, given that the first one is
+    `new_op` at instruction `site`, the `step`-th instruction on the
+    original path.
+    """
+    step, site, new_op = task
+    program = worker_state["program"]
+    history = worker_state["history"]
+    stats = {"n_runs": 0, "n_steps": 0}
+    if worker_state["cancelled"].is_set():
+        return None, stats
+
+    visited = visited_before(step)
+    opcodes = program.opcodes
+    op = opcodes[site]
+    opcodes[site] = new_op
+    try:
+        found = search_patches(
+            program,
+            site,
+            history.accumulators[step],
+            visited,
+            worker_state["max_patches"] - 1,
+            stats,
+            worker_state["cancelled"],
+            frozenset([site]),
+        )
+    finally:
+        opcodes[site] = op
+    if found is not None:
+        found[0][site] = new_op
+    return found, stats
+
+
+def print_progress(progress: dict):
+    print(
+        f"INFO: {progress['n_tasks_done']}/{progress['n_tasks']} patch sites done, "
+        f"{progress['n_runs']} runs, "
+        f"{progress['steps_per_second']:.3g} instructions/s"
+    )
+
+
+def find_patches(
+    program,
+    max_patches: int = 2,
+    n_workers: int = 1,
+    report=None,
+    report_every: float = 1.0,
+) -> tuple:
+    """
+    Find up to `max_patches` simultaneous jmp/nop/acc mutations (see
+    `MUTATIONS`) that make the program halt.
+
+    The first patch site is chosen among the instructions on the original
+    execution path, and each choice is a separate task for a pool of
+    `n_workers` processes (or run in this process if `n_workers` is 1).
+    Every worker holds its own read-only copy of the program, sent once
+    when the pool starts. As soon as one task finds a halting configuration
+    the others are cancelled.
+
+    If given, `report` is called at most every `report_every` seconds
+    (and once at the end) with a dict describing the search progress.
+
+    Returns the dict of {location: new opcode} and the final accumulator,
+    or None.
+    """
+    history = ExecutionHistory(program)
+    if history.result[2] == HALTED:
+        return {}, history.result[0]
+    if max_patches < 1:
+        return None
+
+    terminates = None
+    if max_patches == 1:
+        terminates = find_terminating_instructions(program)
+    tasks = []
+    for step, site in enumerate(history.path):
+        for new_op in MUTATIONS[program.opcodes[site]]:
+            if terminates is not None:
+                argument = program.arguments[site]
+                target = site + argument if new_op == OP_JMP else site + 1
+                if not leads_to_termination(target, terminates):
+                    continue
+            tasks.append((step, site, new_op))
+
+    progress = {
+        "n_tasks": len(tasks),
+        "n_tasks_done": 0,
+        "n_runs": 1,
+        "n_steps": len(history.path),
+        "elapsed": 0.0,
+        "steps_per_second": 0.0,
+    }
+    start_time = time.time()
+    last_report = start_time
+
+    def update_progress(stats, force=False):
+        nonlocal last_report
+        progress["n_tasks_done"] += 1
+        progress["n_runs"] += stats["n_runs"]
+        progress["n_steps"] += stats["n_steps"]
+        now = time.time()
+        progress["elapsed"] = now - start_time
+        progress["steps_per_second"] = progress["n_steps"] / max(
+            progress["elapsed"], 1e-9
+        )
+        if report is not None and (force or now - last_report >= report_every):
+            last_report = now
+            report(dict(progress))
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    found = None
+    if n_workers <= 1:
+        cancelled = multiprocessing.Event()
+        init_patch_worker(
+            program.opcodes, program.arguments, max_patches, cancelled, history
+        )
+        for task in tasks:
+            found, stats = run_patch_task(task)
+            update_progress(stats, force=found is not None)
+            if found is not None:
+                break
+        worker_state.clear()
+    else:
+        # private copies, since the workers patch them while searching (and
+        # memory-mapped images cannot be sent to other processes)
+        opcodes = array("b", program.opcodes)
+        arguments = array("i", program.arguments)
+        with multiprocessing.Manager() as manager:
+            cancelled = manager.Event()
+            pool = multiprocessing.Pool(
+                n_workers,
+                initializer=init_patch_worker,
+                initargs=(opcodes, arguments, max_patches, cancelled),
+            )
+            with pool:
+                for found, stats in pool.imap_unordered(run_patch_task, tasks):
+                    update_progress(stats, force=found is not None)
+                    if found is not None:
+                        # stop the other workers, and drop their queued tasks
+                        cancelled.set()
+                        break
+    if found is None and report is not None:
+        report(dict(progress))
+    return found
+
+
+def basic_blocks(program) -> list:
+    """
+    Split the program into basic blocks, returned as a list of
+    [start, end) instruction ranges. A block starts at the beginning of the
+    program, at any jump target and right after any jmp.
+    """
+    opcodes = program.opcodes
+    arguments = program.arguments
+    n_instructions = len(opcodes)
+    leaders = {0}
+    for sp in range(n_instructions):
+        if opcodes[sp] == OP_JMP:
+            leaders.add(sp + 1)
+            leaders.add(sp + arguments[sp])
+    leaders = sorted(x for x in leaders if 0 <= x < n_instructions)
+    return list(zip(leaders, leaders[1:] + [n_instructions]))
+
+
+class ExecutionTrace:
+    """
+    Record of a traced run of a `CompiledProgram` (see
+    `CompiledProgram.run_traced`):
+        * hits: the number of times each instruction was executed
+        * back_edges: the number of times each backwards (sp, target) jump
+            was taken, i.e. the exit and entry points of the program's loops
+        * loop_entry, loop_exit: for a run that stopped at a repeated
+            instruction, the repeated instruction and the one that led to it
+        * ring: the last `ring_size` (sp, opcode, accumulator) states, where
+            the accumulator is the value after executing the instruction
+    """
+
+    # header of the binary dump: magic, version, number of instructions,
+    # number of ring entries, number of back edges, loop entry and exit
+    HEADER = struct.Struct("<4sHIIIii")
+    MAGIC = b"HHTR"
+    VERSION = 1
+
+    def __init__(self, n_instructions: int, ring_size: int = 64):
+        self.hits = array("q", bytes(8 * n_instructions))
+        self.back_edges = {}
+        self.loop_entry = -1
+        self.loop_exit = -1
+        self.n_steps = 0
+        self.ring = collections.deque(maxlen=ring_size)
+
+    def hot_blocks(self, program, n_top: int = 10) -> list:
+        """
+        The `n_top` basic blocks that executed the most instructions, as a
+        list of (start, end, number of instructions executed).
+        """
+        hits = self.hits
+        blocks = [
+            (start, end, sum(hits[start:end])) for start, end in basic_blocks(program)
+        ]
+        blocks.sort(key=lambda block: block[2], reverse=True)
+        return blocks[:n_top]
+
+    def to_dict(self) -> dict:
+        return {
+            "n_steps": self.n_steps,
+            "hits": list(self.hits),
+            "back_edges": [
+                [source, target, count]
+                for (source, target), count in self.back_edges.items()
+            ],
+            "loop_entry": self.loop_entry,
+            "loop_exit": self.loop_exit,
+            "ring": [list(state) for state in self.ring],
+        }
+
+    def to_json(self, output_path):
+        with open(output_path, "w") as ofile:
+            json.dump(self.to_dict(), ofile)
+
+    def dump(self, output_path):
+        """
+        Write the trace as a flat binary file: the header, followed by
+        the int64 hit counts, the back edges as int32 source, int32 target
+        and int64 count arrays, and the ring buffer as int32 sp, int8 opcode
+        and int64 accumulator arrays. Arrays are in native byte order.
+        """
+        ring = list(self.ring)
+        edges = list(self.back_edges.items())
+        with open(output_path, "wb") as ofile:
+            ofile.write(
+                self.HEADER.pack(
+                    self.MAGIC,
+                    self.VERSION,
+                    len(self.hits),
+                    len(ring),
+                    len(edges),
+                    self.loop_entry,
+                    self.loop_exit,
+                )
+            )
+            self.hits.tofile(ofile)
+            array("i", [source for (source, _), _ in edges]).tofile(ofile)
+            array("i", [target for (_, target), _ in edges]).tofile(ofile)
+            array("q", [count for _, count in edges]).tofile(ofile)
+            array("i", [sp for sp, _, _ in ring]).tofile(ofile)
+            array("b", [op for _, op, _ in ring]).tofile(ofile)
+            array("q", [acc for _, _, acc in ring]).tofile(ofile)
+
+    @classmethod
+    def load(cls, input_path):
+        with open(input_path, "rb") as ifile:
+            header = ifile.read(cls.HEADER.size)
+            (
+                magic,
+                version,
+                n_instructions,
+                n_ring,
+                n_edges,
+                entry,
+                exit_,
+            ) = cls.HEADER.unpack(header)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                print(f"ERROR: {input_path} is not a trace dump")
+                sys.exit(1)
+
+            def read_array(typecode, n):
+                values = array(typecode)
+                values.fromfile(ifile, n)
+                return values
+
+            trace = cls(0, ring_size=max(n_ring, 1))
+            trace.hits = read_array("q", n_instructions)
+            trace.n_steps = sum(trace.hits)
+            sources = read_array("i", n_edges)
+            targets = read_array("i", n_edges)
+            counts = read_array("q", n_edges)
+            trace.back_edges = dict(zip(zip(sources, targets), counts))
+            trace.ring.extend(
+                zip(
+                    read_array("i", n_ring),
+                    read_array("b", n_ring),
+                    read_array("q", n_ring),
+                )
+            )
+            trace.loop_entry, trace.loop_exit = entry, exit_
+        return trace
+
+
+def main(input_path, trace_path=None):
+
+    compiled_program = load_program(input_path)
 
     # part 1
-    # iterate through the program until we hit a repeated instruction
-    for istep, _ in enumerate(program):
-        if program.counts[program.sp] >= 1:
-            break
+    # run the program until we hit a repeated instruction
+    if trace_path is None:
+        accumulator, _, _ = compiled_program.run_until_loop_or_halt()
+    else:
+        trace = ExecutionTrace(len(compiled_program))
+        accumulator, _, _ = compiled_program.run_traced(trace)
+        if trace_path.suffix == ".json":
+            trace.to_json(trace_path)
+        else:
+            trace.dump(trace_path)
+        print(f"PART 1: Wrote execution trace to {trace_path}")
     print(
-        f"PART 1: Accumulator immediately before any repeated instruction = {program.accumulator}"
+        f"PART 1: Accumulator immediately before any repeated instruction = {accumulator}"
     )
 
     # part 2
     # find the location in the program that is corrupted
-    corrupted_instruction = find_corrupted_instruction(program_lines)
-    if corrupted_instruction is None:
+    corrupted_line = find_repair_location(compiled_program)
+    if corrupted_line is None:
         print("ERROR: Did not find a corrupted instruction in input program!")
-    corrupted_instruction, corrupted_line = (
-        corrupted_instruction[0],
-        corrupted_instruction[1],
-    )
+        sys.exit(1)
+    corrupted_instruction = compiled_program.instruction(corrupted_line)[0]
     print(
         f'PART 2: Corrupted instruction is "{corrupted_instruction}" at program line {corrupted_line}'
     )
-    program = Program(program_lines)
-
-    # update the corrupted line
-    program.program[corrupted_line] = [
-        {"jmp": "nop", "nop": "jmp"}[corrupted_instruction],
-        program.program[corrupted_line][1],
-    ]
 
-    # run the program (assume that the infinite loop issue is gone)
-    [s for s in program]
-    if not program.finished:
+    # update the corrupted line and run the program
+    opcodes = compiled_program.opcodes
+    opcodes[corrupted_line] = FLIPPED_OPCODES[opcodes[corrupted_line]]
+    accumulator, _, reason = compiled_program.run_until_loop_or_halt()
+    if reason != HALTED:
         print("PART 2: ERROR program did not finish!")
         sys.exit(1)
-    print(f"PART 2: Program accumulator after corruption fix: {program.accumulator}")
+    print(f"PART 2: Program accumulator after corruption fix: {accumulator}")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="AoC day #8")
     parser.add_argument("input", help="Day #8 input file")
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Write an execution trace of part 1 (JSON if *.json, else binary)",
+    )
     args = parser.parse_args()
 
     input_path = Path(args.input)
     if not input_path.exists():
         print(f"ERROR: bad input '{args.input}'")
         sys.exit(1)
-    main(input_path)
+    main(input_path, Path(args.trace) if args.trace else None)
@@ -9,10 +9,12 @@
 #
 
 import sys
+import asyncio
+import collections
 from argparse import ArgumentParser
 from pathlib import Path
 
-from itertools import islice, combinations
+import numpy as np
 
 
 def test_example_0():
@@ -41,34 +43,290 @@ def test_example_1():
     assert [lo, hi, summed] == [15, 47, 62]
 
 
-def xmas_chunks(input_data: list, window_length: int, advance: int) -> list:
+def test_find_weaknesses():
+    test_data_path = Path("test_input.txt")
+    with open(test_data_path, "r") as ifile:
+        input_data = parse_xmas(ifile)
+    assert list(find_weaknesses(input_data, preamble_length=5)) == [(14, 127)]
+
+
+def test_window_distinct_pair():
+    window = XmasWindow(3)
+    for value in [25, 1, 24]:
+        window.push(value)
+    assert window.has_pair_summing_to(26)
+    assert window.has_pair_summing_to(49)
+    assert not window.has_pair_summing_to(50)  # 25 + 25 is not allowed
+    window.push(25)  # 25 drops out and comes back in
+    assert window.counts == {1: 1, 24: 1, 25: 1}
+    assert not window.has_pair_summing_to(26 + 24)
+
+
+def test_contiguous_ranges():
+    values = [3, 0, 2, 5, -1, 1, 0, 5, 5]
+    expected = {
+        (i, j)
+        for i in range(len(values))
+        for j in range(i + 2, len(values) + 1)
+        if sum(values[i:j]) == 5
+    }
+    assert set(contiguous_ranges_prefix_sum(values, 5)) == expected
+    assert set(contiguous_ranges_prefix_sum(np.array(values), 5)) == expected
+
+    values = [abs(x) for x in values]
+    expected = {
+        (i, j)
+        for i in range(len(values))
+        for j in range(i + 2, len(values) + 1)
+        if sum(values[i:j]) == 5
+    }
+    assert set(contiguous_ranges_two_pointer(values, 5)) == expected
+    assert set(contiguous_ranges_two_pointer(np.array(values), 5)) == expected
+
+
+def test_big_values():
+    values = as_int64_array([2 ** 62, 2 ** 62, 3, 2 ** 63])
+    assert isinstance(values, list)
+    assert list(contiguous_ranges(values, 2 ** 63 + 3)) == [(0, 3), (2, 4)]
+    assert list(contiguous_sets(values, 2 ** 63 + 3)) == [
+        (0, 3, [2 ** 62, 2 ** 62, 3]),
+        (2, 4, [3, 2 ** 63]),
+    ]
+
+
+def test_big_target():
+    # small words, but a target that does not fit in int64
+    assert isinstance(as_int64_array([1, 2, 3], 2 ** 63 + 5), list)
+    assert contiguous_set_that_sums_to(2 ** 63 + 5, ["1", "2", "3"]) is None
+    assert contiguous_set_that_sums_to(-(2 ** 63) - 5, ["1", "2", "-3"]) is None
+    assert contiguous_set_that_sums_to(5, ["1", "2", "3"]) == [2, 3]
+
+    # the words fit, but adding the target to their prefix sums would not
+    values = np.array([1, 2, 2 ** 62, 2 ** 61], dtype=np.int64)
+    for summed_value in (2 ** 63 - 2, 2 ** 62 + 2 ** 61 + 2):
+        assert list(contiguous_ranges_two_pointer(values, summed_value)) == list(
+            contiguous_ranges_two_pointer(values.tolist(), summed_value)
+        )
+    assert list(contiguous_sets(values, 2 ** 62 + 2 ** 61 + 2)) == [
+        (1, 4, [2, 2 ** 62, 2 ** 61])
+    ]
+
+
+def test_watch_stream_back_pressure():
+    test_data_path = Path("test_input.txt")
+    with open(test_data_path, "r") as ifile:
+        input_data = parse_xmas(ifile)
+    n_produced = 0
+
+    async def producer():
+        nonlocal n_produced
+        for word in input_data:
+            n_produced += 1
+            yield word
+
+    async def first_event():
+        async for event in watch_xmas_stream(producer(), preamble_length=5):
+            return event
+
+    # the producer is not read past the invalid word until the event is handled
+    assert asyncio.run(first_event()) == (14, 127)
+    assert n_produced == 15
+
+
+def test_watch_stream_reader():
+    test_data_path = Path("test_input.txt")
+    with open(test_data_path, "r") as ifile:
+        data = ifile.read().encode()
+
+    async def run():
+        reader = asyncio.StreamReader()
+
+        async def fake_producer():
+            # dribble the feed in, splitting lines across writes
+            for start in range(0, len(data), 7):
+                end = start + 7
+                reader.feed_data(data[start:end])
+                await asyncio.sleep(0)
+            reader.feed_data(b"1\n")
+            reader.feed_eof()
+
+        producer = asyncio.ensure_future(fake_producer())
+        words = read_xmas_words(reader)
+        events = [event async for event in watch_xmas_stream(words, 5)]
+        await producer
+        return events
+
+    assert asyncio.run(run()) == [(14, 127), (20, 1)]
+
+
+def test_sweep_preambles():
+    test_data_path = Path("test_input.txt")
+    with open(test_data_path, "r") as ifile:
+        input_data = parse_xmas(ifile)
+    sweep = sweep_preambles(input_data, 10)
+    assert sweep[5] == (14, 127)
+    for preamble_length in range(2, 11):
+        first = next(find_weaknesses(input_data, preamble_length), None)
+        assert sweep[preamble_length] == first
+
+
+def parse_xmas(input_data) -> list:
+    """
+    Convert the lines of an XMAS stream to ints, once, skipping blank lines.
+    """
+    return [int(x) for x in input_data if x.strip()]
+
+
+class XmasWindow:
+    """
+    The last `preamble_length` numbers of an XMAS stream, kept both in
+    arrival order and as a value -> count multiset so that adding a number
+    (and dropping the oldest one) is O(1).
+    """
+
+    def __init__(self, preamble_length: int):
+        self.preamble_length = preamble_length
+        self.values = collections.deque()
+        self.counts = {}
+
+    def is_full(self) -> bool:
+        return len(self.values) == self.preamble_length
+
+    def push(self, value: int):
+        counts = self.counts
+        self.values.append(value)
+        counts[value] = counts.get(value, 0) + 1
+        if len(self.values) > self.preamble_length:
+            oldest = self.values.popleft()
+            if counts[oldest] == 1:
+                del counts[oldest]
+            else:
+                counts[oldest] -= 1
+
+    def has_pair_summing_to(self, word: int) -> bool:
+        """
+        Whether two different values in the window sum to `word`, using a
+        single membership check per distinct value in the window.
+        """
+        counts = self.counts
+        for value in counts:
+            other = word - value
+            if other != value and other in counts:
+                return True
+        return False
+
+
+def find_weaknesses(words, preamble_length: int):
+    """
+    Generator over the (index, word) of every word in the stream `words`
+    that is not the sum of two of the previous `preamble_length` words.
+    The time taken is linear in the length of the stream.
+    """
+    window = XmasWindow(preamble_length)
+    for index, word in enumerate(words):
+        if window.is_full() and not window.has_pair_summing_to(word):
+            yield index, word
+        window.push(word)
+
+
+def sweep_preambles(words: list, max_preamble: int, min_preamble: int = 2) -> dict:
     """
-    Generator that iterates through `input_data` by windows
-    of length `window_length`, with the start position of
-    the window advancing by `advance` positions at each step in the
-    iteration.
+    Find the first invalid word for every preamble length from
+    `min_preamble` to `max_preamble`, in a single pass over `words`.
+
+    Returns a dict of preamble length -> (index, word) of the first invalid
+    word, or None if there is none.
+
+    A word at index i is valid for a preamble of length p if two different
+    values summing to it lie within the previous p words. Scanning backwards
+    from i gives the shortest such p for all windows at once, since the
+    windows are nested. The word is then invalid for all of the preamble
+    lengths below that (and at most i, so that the window is full), so the
+    preamble lengths whose first invalid word has been found always form a
+    range [min_preamble, resolved].
     """
-    step = 0
-    chunk = []
-    while True:
-        chunk = [int(x.strip()) for x in islice(input_data, step, step + window_length)]
-        if len(chunk) != window_length:
+    first_weakness = {p: None for p in range(min_preamble, max_preamble + 1)}
+    resolved = min_preamble - 1
+    for index, word in enumerate(words):
+        if resolved == max_preamble:
             break
-        yield chunk
-        step += advance
+        max_distance = min(index, max_preamble)
+        if max_distance <= resolved:
+            continue
 
+        # the shortest window that makes this word valid
+        seen = set()
+        shortest_valid = max_distance + 1
+        for distance in range(1, max_distance + 1):
+            value = words[index - distance]
+            other = word - value
+            if other != value and other in seen:
+                shortest_valid = distance
+                break
+            seen.add(value)
 
-def find_sets_that_sum_to(word: int, words_to_check: list, length_of_sum=2) -> list:
+        for p in range(resolved + 1, shortest_valid):
+            first_weakness[p] = (index, word)
+        resolved = max(resolved, shortest_valid - 1)
+    return first_weakness
+
+
+async def read_xmas_words(lines):
     """
-    Return a list of lists whose sum are equal to `word`.
-    The size of the sub-lists (from which the sums are derived) are of
-    length `length_of_sum`.
+    Async generator over the words in an async iterable of lines, such as
+    an `asyncio.StreamReader` connected to a pipe or a socket.
     """
-    return list(
-        filter(
-            lambda x: sum(x) == word, combinations(set(words_to_check), length_of_sum)
-        )
-    )
+    async for line in lines:
+        line = line.strip()
+        if line:
+            yield int(line)
+
+
+async def follow_xmas_file(input_path, poll_interval: float = 0.25):
+    """
+    Async generator over the words of a file that is still being written
+    to (like `tail -f`), checking for new data every `poll_interval`
+    seconds. It never finishes on its own.
+    """
+    with open(input_path, "rb") as ifile:
+        partial_line = b""
+        while True:
+            line = ifile.readline()
+            if not line:
+                await asyncio.sleep(poll_interval)
+                continue
+            partial_line += line
+            if not partial_line.endswith(b"\n"):
+                continue  # the rest of the line has not been written yet
+            line, partial_line = partial_line.strip(), b""
+            if line:
+                yield int(line)
+
+
+async def watch_xmas_stream(words, preamble_length: int):
+    """
+    Async generator over the (index, word) of every invalid word in the
+    async iterable `words`, as soon as it arrives.
+
+    Only the last `preamble_length` words are kept in memory. Words are
+    only pulled from `words` while the caller is waiting for the next
+    event, so a slow consumer holds back the reader (and, for a stream
+    reader, the connection) rather than having the words pile up.
+    """
+    window = XmasWindow(preamble_length)
+    index = 0
+    async for word in words:
+        if window.is_full() and not window.has_pair_summing_to(word):
+            yield index, word
+        window.push(word)
+        index += 1
+
+
+async def follow(input_path, preamble_length: int):
+    async for index, word in watch_xmas_stream(
+        follow_xmas_file(input_path), preamble_length
+    ):
+        print(f"WEAKNESS: word {index} = {word}")
 
 
 def find_first_weakness(input_data: list, preamble_length: int) -> int:
@@ -76,37 +334,140 @@ def find_first_weakness(input_data: list, preamble_length: int) -> int:
     Find the first word in `input_data` that cannot be the result
     of the sum of the previous `preamble_length` words.
     """
-    for chunk in xmas_chunks(input_data, preamble_length + 1, 1):
-        previous_words, current_word = chunk[:preamble_length], chunk[-1]
-        words_that_sum = find_sets_that_sum_to(current_word, previous_words)
-
-        # found the case where there are no previous words that sum to the current one
-        if not words_that_sum:
-            return current_word
+    for _, word in find_weaknesses(parse_xmas(input_data), preamble_length):
+        return word
     return None
 
 
+def as_int64_array(values: list, summed_value: int = 0):
+    """
+    Convert the words to a numpy int64 array, unless they are too large for
+    all of their partial sums (offset by `summed_value`, the sum being
+    searched for) to fit in 64 bits, in which case the list of python ints
+    is returned as is.
+    """
+    if not values:
+        return np.array(values, dtype=np.int64)
+    if max(abs(x) for x in values) * len(values) + abs(summed_value) >= 2 ** 63:
+        return values
+    return np.array(values, dtype=np.int64)
+
+
+def prefix_sums(values):
+    """
+    prefix[i] is the sum of the first i words, so that the sum of the words
+    in [start, end) is prefix[end] - prefix[start].
+    """
+    if isinstance(values, np.ndarray):
+        return np.concatenate(([0], np.cumsum(values)))
+    prefix = [0]
+    total = 0
+    for value in values:
+        total += value
+        prefix.append(total)
+    return prefix
+
+
+def contiguous_ranges_two_pointer(values, summed_value: int, min_length: int = 2):
+    """
+    Generator over every [start, end) range of at least `min_length` words
+    that sum to `summed_value`, for streams of non-negative words, in order
+    of `start`. This is O(N) plus the number of ranges found.
+
+    The prefix sums of non-negative words never decrease, so for each
+    `start` the matching `end`s are a contiguous block of positions,
+    [lo, hi), that only ever moves forwards.
+    """
+    prefix = prefix_sums(values)
+    n_words = len(values)
+    if isinstance(values, np.ndarray):
+        if int(np.abs(prefix).max()) + abs(summed_value) >= 2 ** 63:
+            # the targets do not fit in int64, so search with python ints
+            values = values.tolist()
+            prefix = prefix.tolist()
+    if isinstance(values, np.ndarray):
+        # the same search, but for all starts at once
+        targets = prefix[:-1] + summed_value
+        lo = np.searchsorted(prefix, targets, side="left")
+        hi = np.searchsorted(prefix, targets, side="right")
+        lo = np.maximum(lo, np.arange(n_words) + min_length)
+        for start in np.nonzero(lo < hi)[0].tolist():
+            for end in range(int(lo[start]), int(hi[start])):
+                yield start, end
+        return
+
+    lo = hi = 0
+    for start in range(n_words):
+        target = prefix[start] + summed_value
+        while lo <= n_words and prefix[lo] < target:
+            lo += 1
+        hi = max(hi, lo)
+        while hi <= n_words and prefix[hi] == target:
+            hi += 1
+        for end in range(max(lo, start + min_length), hi):
+            yield start, end
+
+
+def contiguous_ranges_prefix_sum(values, summed_value: int, min_length: int = 2):
+    """
+    Generator over every [start, end) range of at least `min_length` words
+    that sum to `summed_value`, for streams of words of any sign, in order
+    of `end`. Each prefix sum is looked up once in a map of the earlier
+    prefix sums to where they occurred.
+    """
+    prefix = prefix_sums(values)
+    if isinstance(values, np.ndarray):
+        prefix = prefix.tolist()
+    starts_with_prefix = collections.defaultdict(list)
+    for end in range(min_length, len(prefix)):
+        starts_with_prefix[prefix[end - min_length]].append(end - min_length)
+        for start in starts_with_prefix.get(prefix[end] - summed_value, []):
+            yield start, end
+
+
+def contiguous_ranges(values, summed_value: int, min_length: int = 2):
+    """
+    Generator over every [start, end) range of at least `min_length` words
+    that sum to `summed_value`, using the two-pointer search if none of the
+    words are negative and the prefix sum search otherwise.
+    """
+    if len(values) == 0 or min(values) >= 0:
+        return contiguous_ranges_two_pointer(values, summed_value, min_length)
+    return contiguous_ranges_prefix_sum(values, summed_value, min_length)
+
+
+def contiguous_sets(values, summed_value: int, min_length: int = 2):
+    """
+    Generator over the same ranges as `contiguous_ranges`, as
+    (start, end, words) with the words in [start, end) as python ints.
+    """
+    for start, end in contiguous_ranges(values, summed_value, min_length):
+        yield start, end, [int(x) for x in values[start:end]]
+
+
 def contiguous_set_that_sums_to(summed_value: int, input_data: list) -> list:
     """
     Find the contiguous set of words in the input data `input_data` list
     that sum to the requested value `summed_value`.
 
-    This function assumes that there is only one such contiguous set,
-    and exits once the first such set is found.
+    If there is more than one such set, the shortest (and then the first)
+    one is returned.
     """
-    for length in range(2, len(input_data)):
-        for chunk in xmas_chunks(input_data, length, 1):
-            if sum(chunk) == summed_value:
-                return chunk
-    return None
+    values = as_int64_array(parse_xmas(input_data), summed_value)
+    ranges = contiguous_ranges(values, summed_value)
+    shortest = min(ranges, key=lambda r: (r[1] - r[0], r[0]), default=None)
+    if shortest is None:
+        return None
+    start, end = shortest
+    return [int(x) for x in values[start:end]]
 
 
-def main(input_path):
+def main(input_path, preamble_length=25):
 
     with open(input_path, "r") as ifile:
         input_data = [x.strip() for x in ifile.readlines()]
     # part 1
-    first_weakness = find_first_weakness(input_data, 25)
+    first_weakness = find_first_weakness(input_data, preamble_length)
     print(f"PART 1: First weakness = {first_weakness}")
 
     # part 2
@@ -123,10 +484,24 @@ def main(input_path):
 if __name__ == "__main__":
     parser = ArgumentParser(description="AoC day #9")
     parser.add_argument("input", help="Day #9 input file")
+    parser.add_argument(
+        "--preamble", type=int, default=25, help="Length of the XMAS preamble"
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Keep watching the input file and report every invalid word",
+    )
     args = parser.parse_args()
 
     input_path = Path(args.input)
     if not input_path.exists():
         print(f"ERROR: bad input '{args.input}'")
         sys.exit(1)
-    main(input_path)
+    if args.follow:
+        try:
+            asyncio.run(follow(input_path, args.preamble))
+        except KeyboardInterrupt:
+            pass
+    else:
+        main(input_path, args.preamble)
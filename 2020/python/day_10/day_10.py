@@ -11,12 +11,15 @@
 import sys
 from argparse import ArgumentParser
 from pathlib import Path
-import functools
+
+import heapq
+import random
+import tempfile
+import itertools
+import collections
 
 import pytest
 import numpy as np
-import collections
-from itertools import groupby
 
 
 @pytest.fixture
@@ -83,6 +86,15 @@ def test_example_1(example_data_1):
     assert find_diff_distribution(example_data_1) == {1: 22, 3: 10}
 
 
+def test_external_diff_distribution(tmp_path, example_data_0, example_data_1):
+    for input_data in [example_data_0, example_data_1]:
+        input_path = tmp_path / "adapters.txt"
+        input_path.write_text("\n".join(str(x) for x in input_data) + "\n")
+        assert find_diff_distribution_external(
+            input_path, run_length=4, block_length=3
+        ) == find_diff_distribution(input_data)
+
+
 def test_n_all_configurations_0(example_data_0):
     assert find_n_valid_ways(example_data_0) == 8
 
@@ -91,182 +103,421 @@ def test_n_all_configurations_1(example_data_1):
     assert find_n_valid_ways(example_data_1) == 19208
 
 
+def test_n_configurations_with_gaps_of_2():
+    # every subset of [1, 2, 4, 5] that keeps the gaps at or below 3
+    assert find_n_valid_ways([1, 2, 4, 5]) == 5
+    assert find_n_valid_ways([1, 2, 4, 5], max_jump=2) == 2
+
+
+def test_n_configurations_big():
+    # with every rating from 1 to 1000, the counts are the tribonacci numbers
+    ways = [1, 1, 2]
+    for _ in range(1000 - 2):
+        ways.append(sum(ways[-3:]))
+    assert find_n_valid_ways(list(range(1, 1001))) == ways[-1]
+    assert ways[-1] > 2 ** 64
+
+
+def test_arrangements(example_data_0):
+    arrangements = AdapterArrangements(example_data_0)
+    assert arrangements.n_arrangements == 8
+    listed = list(arrangements.iter_arrangements())
+    assert len(listed) == 8
+    assert listed == sorted(listed)
+    assert listed[0] == [1, 4, 5, 6, 7, 10, 11, 12, 15, 16, 19]
+    assert listed[-1] == [1, 4, 7, 10, 12, 15, 16, 19]
+    for chain in listed:
+        gaps = np.diff([0] + chain + [chain[-1] + 3])
+        assert gaps.min() >= 1 and gaps.max() <= 3
+    assert [arrangements.unrank(k) for k in range(8)] == listed
+    assert arrangements.unrank(8) is None
+    assert list(arrangements.iter_arrangements(5)) == listed[5:]
+    assert arrangements.page(1, 3) == listed[3:6]
+    assert arrangements.page(2, 3) == listed[6:]
+    assert all(x in listed for x in arrangements.sample(5, random.Random(10)))
+
+
+def test_arrangements_segments():
+    # runs of four adapters 3 jolts apart: every run starts and ends with a cut
+    ratings = [r + 6 * i for i in range(300) for r in (1, 2, 3, 4)]
+    arrangements = AdapterArrangements(ratings)
+    assert arrangements.n_arrangements == find_n_valid_ways(ratings) == 7 * 4 ** 299
+    assert max(arrangements.ways) == 7
+    assert arrangements.cuts[:4] == [0, 4, 5, 8]
+
+    k = 7 ** 300 // 3
+    assert mixed_radix_digits(k, [7] * 300) == [
+        k // 7 ** (299 - i) % 7 for i in range(300)
+    ]
+    n = arrangements.n_arrangements
+    for k in (0, n // 3, n - 2):
+        following = list(itertools.islice(arrangements.iter_arrangements(k), 2))
+        assert following == [arrangements.unrank(k), arrangements.unrank(k + 1)]
+    assert arrangements.unrank(n - 1)[:3] == [3, 4, 7]
+
+
+def test_arrangements_unrank_big():
+    arrangements = AdapterArrangements(list(range(1, 1001)))
+    assert arrangements.n_arrangements == find_n_valid_ways(list(range(1, 1001)))
+    # the first arrangement uses every adapter, the last takes the largest steps
+    assert arrangements.unrank(0) == list(range(1, 1001))
+    last = arrangements.unrank(arrangements.n_arrangements - 1)
+    assert last == list(range(3, 1000, 3)) + [1000]
+    middle = arrangements.n_arrangements // 4
+    page = arrangements.page(middle, 2)
+    assert page == [
+        arrangements.unrank(2 * middle),
+        arrangements.unrank(2 * middle + 1),
+    ]
+
+
+# above this, a histogram of the differences is too sparse for np.bincount
+MAX_BINCOUNT_DIFF = 1 << 16
+
+
 def find_diff_distribution(input_data: list) -> dict:
     """
     Take the input data and compute the element-wise diff.
     Return the count of each of the uniquely appearing difference values.
     """
-    input_data = collections.deque(sorted(input_data))
-    input_data.appendleft(0)  # the wall plug
-    input_data.append(
-        input_data[-1] + 3
-    )  # the device is +3 joltage rating relative to last element
-    diffs = list(np.diff(np.array(input_data)))
-
-    unique_diffs = list(set(diffs))
-    counts = [diffs.count(x) for x in unique_diffs]
-    counts = dict(zip(unique_diffs, counts))
-    return counts
-
-
-def find_runs(diffs):
+    ratings = np.sort(np.asarray(input_data, dtype=np.int64))
+    device = (ratings[-1] if len(ratings) else 0) + 3
+    # the wall plug, the adapters, and the device (+3 relative to last element)
+    diffs = np.diff(np.concatenate(([0], ratings, [device])))
+    if diffs.max() > MAX_BINCOUNT_DIFF:
+        unique_diffs, counts = np.unique(diffs, return_counts=True)
+        return dict(zip(unique_diffs.tolist(), counts.tolist()))
+    counts = np.bincount(diffs)
+    return {diff: int(count) for diff, count in enumerate(counts) if count}
+
+
+def write_sorted_runs(input_path, run_dir, run_length: int) -> list:
     """
-    Find all continuous runs of elements of value 1, that are longer than 1.
+    Read the adapter ratings from `input_path` in chunks of `run_length`,
+    and write each chunk, sorted, to its own file in `run_dir`.
     """
-    return [
-        x
-        for x in [list(run) for run_value, run in groupby(diffs) if run_value == 1]
-        if len(x) > 1
-    ]
-
+    run_paths = []
+    with open(input_path, "r") as ifile:
+        while True:
+            lines = list(itertools.islice(ifile, run_length))
+            if not lines:
+                break
+            run = np.array([int(x) for x in lines if x.strip()], dtype=np.int64)
+            run_path = Path(run_dir) / f"run_{len(run_paths)}.npy"
+            np.save(run_path, np.sort(run))
+            run_paths.append(run_path)
+    return run_paths
 
-@functools.lru_cache(maxsize=100)
-def find_n_inclusive(run_length: int) -> int:
 
+def iter_sorted_run(run_path, block_length: int):
     """
-    This function takes in the length of a 1-valued run of adapter joltage rating
-    differences and creates all possible arrays of the same length
-    where non-zero elements represent the positions of the corresponding
-    joltage adapters that can be removed from the list and still satisfy
-    the requirement that the no adapter is followed by one whose joltage rating
-    differs by greater than 3.
-
-    An element can be filled as long it satisfies the following requirements:
-       - If after adding that element, there will be no run of filled elements
-            that is of size 3 or greater
-       - We have not wrapped around the whole length of the array
-
-    Element filling starts at the first column (where a column ranges from
-    [0,len(run)). Once element filling has wrapped around, the column is
-    advanced by one and the process begins again.
-
-    The filling process follows a "growth" and "pop" process.
-    We fill an array of 0's of length len(run), and create a seed
-    element at index 0. Then the "growth" and "pop" process begins, starting
-    with "growth" and moving to "pop", alternating:
-        "growth": in this stage, an element immediately to the right (with wrap-around)
-                   of the previous filled element is filled
-        "pop":    the previous filled element is advanced by one position in the array,
-                    thus making this position now filled (and it's previous position
-                    no longer being filled)
-    Once a wrap-around of the array has been detected, the "growth" and "pop"
-    stage re-starts, but advancing the initial seed element (row) by one position.
-
-    For example, for a `run` of length 4:
-    --------------------------------
-    [1,0,0,0] # SEED 0
-    [1,1,0,0] # growth
-    [1,0,1,0] # pop
-    [1,0,1,1] # growth // WRAP AROUND DETECTED
-    [0,1,0,0] # SEED 1
-    [0,1,1,0] # growth
-    [0,1,0,1] # pop
-    [1,1,0,1] # growth // the "next" position wraps around
-              #    -> at this point, a *pop* would result in a run of 3,
-              #       and it is skipped
-    [0,0,1,0] # SEED 2
-    [0,0,1,1] # growth
-    [1,0,1,0] # pop
-    ...
-    ...
-    ---------------------------------
-    What is returned is the number of unique arrays,
-    representing the number of ways that the adapters in the
-    input run can be removed/shifted.
+    Generator over the ratings in a sorted run file, loading
+    `block_length` of them at a time.
     """
+    run = np.load(run_path, mmap_mode="r")
+    for start in range(0, len(run), block_length):
+        end = start + block_length
+        yield from run[start:end].tolist()
 
-    possibilities = []
-    for start_idx in range(run_length):
-        start_field = [0 for _ in range(run_length)]
-        start_field[start_idx] = 1
-        possibilities.append(start_field)
-
-        stage = 0
-        current_idx = start_idx
-        while True:
-            last_field = list(possibilities[-1])  # copy
-
-            if stage % 2 == 0:  # grow stage
-                # this is the growth stage, where the element just to the right
-                # of the last-tagged element is tagged
-                field = last_field
-                current_idx = (current_idx + 1) % run_length
-                field[current_idx] = 1
-                field = list(field)
-                if field not in possibilities:
-                    possibilities.append(field)
-            else:
-                # in this stage we "pop" the last element that was grown
-                # off and advance it to the right by one
-                field = last_field
-                field[current_idx] = 0
-                current_idx = (current_idx + 1) % run_length
-                field[current_idx] = 1
-                if current_idx == start_idx:
-                    break
-                field = list(field)
-                if field not in possibilities:
-                    possibilities.append(field)
 
-            # if the current_idx == start_idx, then we have definitely wrapped around
-            if current_idx == start_idx:
-                break
-            stage += 1
-    return len(possibilities)
+def diff_histogram(sorted_ratings) -> dict:
+    """
+    Count the differences between consecutive ratings in the sorted stream
+    `sorted_ratings`, starting from the wall plug and ending with the
+    device (+3 relative to the last rating).
+    """
+    counts = collections.Counter()
+    previous = 0
+    for rating in sorted_ratings:
+        counts[rating - previous] += 1
+        previous = rating
+    counts[3] += 1
+    return dict(counts)
+
+
+def find_diff_distribution_external(
+    input_path, run_length: int = 1 << 22, block_length: int = 1 << 16
+) -> dict:
+    """
+    Same as `find_diff_distribution`, but for adapter files that do not fit
+    in memory: the file is split into sorted runs of `run_length` ratings on
+    disk, which are merged with `heapq.merge` into a single sorted stream
+    that is counted on the fly.
+    """
+    with tempfile.TemporaryDirectory() as run_dir:
+        run_paths = write_sorted_runs(input_path, run_dir, run_length)
+        runs = [iter_sorted_run(path, block_length) for path in run_paths]
+        return diff_histogram(heapq.merge(*runs))
 
 
-def find_n_valid_ways(input_data: list) -> int:
+def product(values: list) -> int:
+    """
+    Multiply the values pairwise in a balanced tree, which keeps the big
+    int multiplications balanced (and much faster) compared to multiplying
+    them one at a time.
+    """
+    values = list(values)
+    if not values:
+        return 1
+    while len(values) > 1:
+        values = [
+            values[i] * values[i + 1] if i + 1 < len(values) else values[i]
+            for i in range(0, len(values), 2)
+        ]
+    return values[0]
+
+
+def find_n_valid_ways(input_data: list, max_jump: int = 3) -> int:
     """
     Find all possible adapter configurations that satisfy the
-    rules of not having a ∆ of joltage rating greater than 3.
+    rules of not having a ∆ of joltage rating greater than `max_jump`
+    (the device is `max_jump` above the highest rated adapter).
 
     Adapters can be removed from the list, so long as the list after
     the removal still satisfies the rules.
+
+    This is a DP over the sorted adapters: the number of ways to reach an
+    adapter is the sum of the number of ways to reach each of the adapters
+    that are between 1 and `max_jump` jolts below it. Those adapters are a
+    window that only moves forwards, so each step is O(1) with a running
+    sum, and the counts are exact python ints.
+
+    If an adapter can only be fed by a single other adapter, every
+    configuration has to go through that one (the adapters before it are
+    too far below everything after it). Its count is then set aside as a
+    factor and the DP carries on from 1, so the numbers being added stay
+    small, and the factors are multiplied together at the end.
     """
+    ratings = sorted(input_data)
+    window = collections.deque([[0, 1]])  # [rating, ways] of possible feeders
+    window_sum = 1
+    factors = []
+    i = 0
+    while i < len(ratings):
+        rating = ratings[i]
+        while window and window[0][0] < rating - max_jump:
+            window_sum -= window.popleft()[1]
+        if not window:
+            return 0
+        if len(window) == 1 and window[0][1] > 1:
+            factors.append(window[0][1])
+            window[0][1] = window_sum = 1
+
+        # adapters with the same rating cannot feed each other
+        n_ways = window_sum
+        while i < len(ratings) and ratings[i] == rating:
+            window.append([rating, n_ways])
+            window_sum += n_ways
+            i += 1
+
+    # only the highest rated adapters can feed the device
+    device = window[-1][0] + max_jump
+    return product(factors) * sum(n for r, n in window if r >= device - max_jump)
+
+
+def mixed_radix_digits(k: int, radices: list) -> list:
+    """
+    The digits of k in the mixed radix `radices`, most significant first.
+
+    Long numbers are split in two with one big division by the product of
+    the lower half of the radices, rather than dividing out each of the
+    digits in turn, which would go over the whole of k every time.
+    """
+    if len(radices) <= 64:
+        digits = []
+        for radix in reversed(radices):
+            k, digit = divmod(k, radix)
+            digits.append(digit)
+        return digits[::-1]
+    middle = len(radices) // 2
+    high, low = divmod(k, product(radices[middle:]))
+    return mixed_radix_digits(high, radices[:middle]) + mixed_radix_digits(
+        low, radices[middle:]
+    )
+
 
-    # define the data structure
-    input_data = collections.deque(sorted(input_data))
-    input_data.appendleft(0)  # the wall plug
-    input_data.append(
-        input_data[-1] + 3
-    )  # the device is +3 joltage rating relative to last element
-    input_data = np.array(input_data)
-
-    # compute the element-wise difference, to compute the joltage rating differences
-    # from the sorted joltage ratings
-    diffs = np.diff(input_data)
-
-    # If we are to create new configurations of the joltage adapters that still
-    # satisfy the requirement that no adjacent adapters have joltage ratings
-    # that differ by no more than 3 relative to the current one, then we will
-    # only ever be able to shift around (i.e. REMOVE) adapters whose joltage
-    # rating differs by 1 relative to their neighbors. So here we get all
-    # of the runs of differences that are equal to 1. That is, if the `diffs`
-    # array is [3,1,1,1,3,1,3,1,1,3], then `find_runs` gives us: [[1,1,1],[1],[1,1]].
-    #
-    # We assume that there are no joltage rating difference of value 2.
-    #
-    # The runs in which we perform joltage adapter shifts are independent of
-    # each other (i.e. removing element at index 4 does not impact
-    # the validity of the element at index 22), which is why we can do it this way.
-    runs_of_ones = find_runs(diffs)
-    adapter_configurations = []
-    for irun, run in enumerate(runs_of_ones):
-        # we cannot remove the last element, since the next element beyond it
-        # is a ∆ of 3, so remove it from elements that can be considered
-        # to be removed/permuted
-        run = run[:-1]
-
-        # Find the number of all combinations of positions in this run of ∆=1 adapters that can be
-        # marked as safe for removal in order to create a new adapter configuration.
-        n_adapter_combinations_for_run = find_n_inclusive(int(len(run)))
-
-        # add 1 for the configuration where no adapters are removed and/or shifted
-        adapter_configurations.append(n_adapter_combinations_for_run + 1)
-
-    # take the product of the number of per-run adapter configurations to
-    # get the total number of combinations across the entire set of adapters
-    return np.prod(adapter_configurations)
+class AdapterArrangements:
+    """
+    The valid adapter configurations (or "arrangements"), each one being
+    the list of adapter ratings that are used, in the order in which they
+    are chained from the wall plug to the device.
+
+    The arrangements are ordered lexicographically, and can be looked up
+    by their index ("rank") directly, without listing the ones before:
+    for each adapter we keep the number of ways to get from it onwards, so
+    at each adapter in the chain we know how many arrangements are behind
+    each of the possible next adapters.
+
+    As in `find_n_valid_ways`, the chain is cut at the adapters that every
+    arrangement goes through, and the counts only go as far as the next
+    cut. Every arrangement is then one choice of path through each segment
+    between cuts, and a rank is split into one digit per segment (the
+    first segment being the most significant). For inputs whose adapters
+    come in short runs between such cuts, like the puzzle input, the
+    counts stay small; a long run without a cut still needs an exact count
+    of up to O(n) bits for each of its adapters.
+    """
+
+    def __init__(self, input_data: list, max_jump: int = 3):
+        # index 0 is the wall plug
+        self.ratings = [0] + sorted(input_data)
+        self.max_jump = max_jump
+        self.device = self.ratings[-1] + max_jump
+
+        # the adapters that adapter i can feed are in [first_next[i], end_next[i])
+        n = len(self.ratings)
+        self.first_next = [0] * n
+        self.end_next = [0] * n
+        first, end = 0, 0
+        for i, rating in enumerate(self.ratings):
+            while first < n and self.ratings[first] <= rating:
+                first += 1
+            while end < n and self.ratings[end] <= rating + self.max_jump:
+                end += 1
+            self.first_next[i], self.end_next[i] = first, end
+
+        # adapter c is a cut if nothing before it can feed anything after it
+        # (or the device), which also rules out another adapter with its rating
+        self.is_cut = bytearray(n)
+        self.is_cut[0] = 1
+        reach = 0
+        for c in range(1, n):
+            reach = max(reach, self.end_next[c - 1])
+            if reach <= c + 1 and self.ratings[c - 1] < self.ratings[c]:
+                self.is_cut[c] = 1
+        self.cuts = [c for c in range(n) if self.is_cut[c]]
+
+        # backwards DP over a running sum of the counts of the window, where
+        # ways[i] is the number of ways from adapter i to the next cut
+        self.ways = [0] * n
+        window_sum = 0
+        first, end = n, n
+        for i in reversed(range(n)):
+            while first > self.first_next[i]:
+                first -= 1
+                window_sum += self.count(first)
+            while end > self.end_next[i]:
+                end -= 1
+                window_sum -= self.count(end)
+            self.ways[i] = window_sum + int(self.ends(i))
+        self.n_arrangements = product(self.ways[c] for c in self.cuts)
+
+    def count(self, j: int) -> int:
+        """
+        The number of ways from adapter j to the end of the segment that
+        it is in (which is 1 for the cut at the end of a segment).
+        """
+        return 1 if self.is_cut[j] else self.ways[j]
+
+    def ends(self, i: int) -> bool:
+        """
+        Whether adapter i can feed the device directly.
+        """
+        return i > 0 and self.device - self.ratings[i] <= self.max_jump
+
+    def next_adapters(self, i: int, after: int = None):
+        """
+        The adapters that adapter i can feed and that lead to the device,
+        in increasing order of rating (and only those after adapter `after`).
+        """
+        first = self.first_next[i] if after is None else after + 1
+        for j in range(first, self.end_next[i]):
+            if self.ways[j]:
+                yield j
+
+    def complete(self, path: list) -> list:
+        """
+        Extend `path` with the lexicographically first way to the device.
+        """
+        while not self.ends(path[-1]):
+            path.append(next(self.next_adapters(path[-1])))
+        return path
+
+    def successor(self, path: list) -> bool:
+        """
+        Step `path` to the next arrangement in place, returning False if
+        it was already the last one.
+
+        Stopping at the device comes before going on to another adapter,
+        so the first thing to try is going past the last adapter, and
+        after that, the next choice of adapter at each level going back up.
+        """
+        after = None
+        while path:
+            j = next(self.next_adapters(path[-1], after), None)
+            if j is not None:
+                path.append(j)
+                self.complete(path)
+                return True
+            after = path.pop()
+        return False
+
+    def unrank_path(self, k: int) -> list:
+        """
+        The adapter indices (starting with the wall plug) of the k-th
+        arrangement, counting from 0, or None if there are not that many.
+        """
+        if not 0 <= k < self.n_arrangements:
+            return None
+        digits = mixed_radix_digits(k, [self.ways[c] for c in self.cuts])
+        path = [0]
+        for k in digits:
+            # from the cut at the start of the segment to the next one
+            while True:
+                i = path[-1]
+                if self.ends(i):
+                    if k == 0:
+                        break
+                    k -= 1
+                for j in self.next_adapters(i):
+                    if k < self.count(j):
+                        path.append(j)
+                        break
+                    k -= self.count(j)
+                if self.is_cut[path[-1]]:
+                    break
+        return path
+
+    def unrank(self, k: int) -> list:
+        """
+        Get the k-th arrangement (counting from 0), or None if there are
+        not that many.
+        """
+        path = self.unrank_path(k)
+        if path is None:
+            return None
+        return [self.ratings[j] for j in path[1:]]
+
+    def iter_arrangements(self, start: int = 0):
+        """
+        Generator over the arrangements in lexicographic order, starting
+        from the `start`-th one. Only the current arrangement is kept
+        around, so the memory used is linear in the number of adapters.
+        """
+        path = self.unrank_path(start)
+        if path is None:
+            return
+        while True:
+            yield [self.ratings[j] for j in path[1:]]
+            if not self.successor(path):
+                return
+
+    def page(self, page_number: int, page_size: int) -> list:
+        """
+        The `page_number`-th group of `page_size` arrangements.
+        """
+        arrangements = self.iter_arrangements(page_number * page_size)
+        return list(itertools.islice(arrangements, page_size))
+
+    def sample(self, n_samples: int, rng=random) -> list:
+        """
+        Draw `n_samples` arrangements uniformly at random (with replacement).
+        """
+        if not self.n_arrangements:
+            return []
+        return [
+            self.unrank(rng.randrange(self.n_arrangements)) for _ in range(n_samples)
+        ]
 
 
 def main(input_path):
@@ -9,10 +9,21 @@
 #
 
 import sys
+import os
+import time
+import zlib
+import struct
+import hashlib
+import functools
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
 from argparse import ArgumentParser
 from pathlib import Path
 
 import pytest
+import numpy as np
 
 
 @pytest.fixture
@@ -94,6 +105,16 @@ def example_data_part1():
     return [[x.strip() for x in t.strip().split("\n") if x != ""] for t in test_data]
 
 
+def random_seats(seed: int, n_rows: int, n_columns: int) -> list:
+    """
+    A random seat configuration, with mostly empty seats, some floor,
+    and a few occupied seats.
+    """
+    rng = np.random.default_rng(seed)
+    layout = rng.choice(list("L.#"), size=(n_rows, n_columns), p=[0.6, 0.3, 0.1])
+    return ["".join(row) for row in layout]
+
+
 def test_round_1(example_data_part1):
     assert apply_rules(example_data_part1[0], True) == [
         x for x in example_data_part1[1] if x
@@ -139,6 +160,30 @@ def test_n_occupied_final(example_data_part1):
     assert n_occupied_seats_in_configuration(configuration) == 37
 
 
+def test_rounds_masks(example_data_part1):
+    seat, occupied = seat_masks(example_data_part1[0])
+    for expected in example_data_part1[1:]:
+        occupied = apply_adjacent_rules(seat, occupied)
+        assert masks_to_seats(seat, occupied) == expected
+
+
+def test_stable_masks(example_data_part1):
+    seat, occupied = seat_masks(example_data_part1[0])
+    n, occupied = find_stable_occupancy(seat, occupied, apply_adjacent_rules)
+    assert n == 5
+    assert masks_to_seats(seat, occupied) == example_data_part1[-1]
+    assert occupied.sum() == 37
+
+
+def test_big_layout_masks():
+    seats = random_seats(11, 300, 300)
+    seat, occupied = seat_masks(seats)
+    n_masks, occupied = find_stable_occupancy(seat, occupied, apply_adjacent_rules)
+    n_strings, configuration = find_stable_configuration(seats, True)
+    assert n_masks == n_strings
+    assert masks_to_seats(seat, occupied) == configuration
+
+
 @pytest.fixture
 def example_data_part2():
     test_data = [
@@ -268,6 +313,246 @@ def test_n_occupied_part2(example_data_part2):
     assert n_occupied_seats_in_configuration(configuration) == 26
 
 
+def test_visible_neighbour_table():
+    test_data = """
+    .##.##.
+    #.#.#.#
+    ##...##
+    ...L...
+    ##...##
+    #.#.#.#
+    .##.##.
+    """
+    test_data = [x.strip() for x in test_data.strip().split("\n") if x != ""]
+    seat, occupied = seat_masks(test_data)
+    index = seat_index_grid(seat)
+    neighbours = visible_neighbour_table(seat)
+    assert neighbours.dtype == np.int32
+    assert neighbours.shape == (seat.sum(), 8)
+    assert (neighbours[index[3, 3]] == -1).all()
+    assert count_table_occupied(neighbours, occupied[seat])[index[3, 3]] == 0
+    assert sorted(neighbours[index[0, 1]][neighbours[index[0, 1]] >= 0]) == sorted(
+        index[[0, 1, 1, 2], [2, 0, 2, 1]]
+    )
+
+
+def test_visible_neighbour_counts(example_data_part2):
+    test_data = """
+    .......#.
+    ...#.....
+    .#.......
+    .........
+    ..#L....#
+    ....#....
+    .........
+    #........
+    ...#.....
+    """
+    test_data = [x.strip() for x in test_data.strip().split("\n") if x != ""]
+    seat, occupied = seat_masks(test_data)
+    counts = count_table_occupied(visible_neighbour_table(seat), occupied[seat])
+    assert counts[seat_index_grid(seat)[4, 3]] == 8
+
+    # every seat, compared against the ray tracing
+    for seats in example_data_part2:
+        seat, occupied = seat_masks(seats)
+        counts = count_table_occupied(visible_neighbour_table(seat), occupied[seat])
+        rows, columns = np.nonzero(seat)
+        assert counts.tolist() == [
+            n_visible_seats_filled([col, row], seats)
+            for row, col in zip(rows.tolist(), columns.tolist())
+        ]
+
+
+def test_stable_neighbour_table(tmp_path, example_data_part2):
+    seat, occupied = seat_masks(example_data_part2[0])
+    neighbours = load_neighbour_table(seat, tmp_path)
+    assert len(list(tmp_path.glob("*" + NEIGHBOURS_SUFFIX))) == 1
+    assert np.array_equal(load_neighbour_table(seat, tmp_path), neighbours)
+    n, occupied_seats = find_stable_occupancy(
+        neighbours, occupied[seat], apply_table_rules
+    )
+    occupied[seat] = occupied_seats
+    assert masks_to_seats(seat, occupied) == example_data_part2[-1]
+    assert occupied_seats.sum() == 26
+
+
+def test_frontier_matches_full_sweep(example_data_part1, example_data_part2):
+    seat, occupied = seat_masks(example_data_part1[0])
+    sizes = []
+    n, occupied_seats = simulate_frontier(
+        adjacent_neighbour_table(seat),
+        occupied[seat],
+        threshold=4,
+        report=lambda n_round, n_frontier, n_changed: sizes.append(n_frontier),
+    )
+    assert n == 5
+    occupied[seat] = occupied_seats
+    assert masks_to_seats(seat, occupied) == example_data_part1[-1]
+    # every seat is looked at in the first round, fewer and fewer after that
+    assert len(sizes) == 6
+    assert sizes[0] == seat.sum()
+    assert sizes[-1] < sizes[0]
+
+    seat, occupied = seat_masks(example_data_part2[0])
+    neighbours = visible_neighbour_table(seat)
+    assert simulate_frontier(neighbours, occupied[seat], threshold=5)[1].sum() == 26
+
+    seat, occupied = seat_masks(random_seats(44, 200, 300))
+    n_full, full = find_stable_occupancy(seat, occupied, apply_adjacent_rules)
+    n, frontier = simulate_frontier(
+        adjacent_neighbour_table(seat), occupied[seat], threshold=4
+    )
+    assert n == n_full
+    assert np.array_equal(frontier, full[seat])
+
+
+def test_bitboard(example_data_part1):
+    board = SeatBitboard.from_seats(example_data_part1[0])
+    assert board.to_seats() == example_data_part1[0]
+    for expected in example_data_part1[1:]:
+        board = board.step()
+        assert board.to_seats() == expected
+    n, board = SeatBitboard.from_seats(example_data_part1[0]).run_until_stable()
+    assert n == 5
+    assert board.n_occupied() == 37
+
+
+def test_bitboard_matches_masks():
+    seats = random_seats(45, 70, 150)
+    seat, occupied = seat_masks(seats)
+    board = SeatBitboard.from_masks(seat, occupied)
+    for threshold in [1, 4, 7]:
+        next_occupied = apply_adjacent_rules(seat, occupied, threshold)
+        next_board = board.step(threshold)
+        assert np.array_equal(next_board.to_masks()[1], next_occupied)
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_shared_simulation(n_workers, example_data_part1, example_data_part2):
+    seat, occupied = seat_masks(example_data_part1[0])
+    n, occupied_seats = simulate_shared(
+        adjacent_neighbour_table(seat), occupied[seat], 4, n_workers
+    )
+    assert n == 5
+    occupied[seat] = occupied_seats
+    assert masks_to_seats(seat, occupied) == example_data_part1[-1]
+
+    seat, occupied = seat_masks(example_data_part2[0])
+    neighbours = visible_neighbour_table(seat)
+    n, occupied_seats = simulate_shared(neighbours, occupied[seat], 5, n_workers)
+    assert (n, occupied_seats.sum()) == (6, 26)
+
+
+def test_rule_engines(example_data_part1, example_data_part2):
+    for engine in ENGINES:
+        n, configuration = PART1_RULE.run(example_data_part1[0], engine, n_workers=2)
+        assert n == 5
+        assert configuration == example_data_part1[-1]
+        if engine == "bitboard":
+            with pytest.raises(SystemExit):
+                PART2_RULE.run(example_data_part2[0], engine)
+            continue
+        n, configuration = PART2_RULE.run(example_data_part2[0], engine, n_workers=2)
+        assert n == 6
+        assert configuration == example_data_part2[-1]
+
+
+def test_rule_variants():
+    seats = random_seats(47, 60, 80)
+    # a radius of 1 is the same as the adjacent seats
+    assert SeatRule(RADIUS, radius=1).run(seats, "vectorized") == PART1_RULE.run(seats)
+    for rule in [
+        SeatRule(RADIUS, radius=2, birth=1, death=9),
+        SeatRule(ADJACENT, birth=1, death=5),
+        SeatRule(LINE_OF_SIGHT, birth=0, death=4),
+    ]:
+        timings = time_engines(rule, seats, n_workers=2)
+        assert len({tuple(result[1:]) for result in timings.values()}) == 1
+        assert None not in next(iter(timings.values()))
+        assert ("bitboard" in timings) == (rule.neighbourhood == ADJACENT)
+
+    # these rules never settle down on this layout, on any engine
+    flipping = SeatRule(ADJACENT, birth=1, death=3)
+    timings = time_engines(flipping, seats, n_workers=2, max_rounds=50)
+    assert sorted(timings) == sorted(ENGINES)
+    assert all(result[1:] == (None, None) for result in timings.values())
+    with pytest.raises(NotStableError):
+        flipping.run(seats, max_rounds=50)
+
+
+def test_rule_cell_types(example_data_part1):
+    rule = SeatRule(cell_types="_ox")
+    seats = [x.replace(".", "_").replace("L", "o") for x in example_data_part1[0]]
+    n, configuration = rule.run(seats)
+    assert n == 5
+    assert configuration == [
+        x.replace(".", "_").replace("L", "o").replace("#", "x")
+        for x in example_data_part1[-1]
+    ]
+
+
+def test_checkpoint_resume(tmp_path, example_data_part1):
+    seat, occupied = PART1_RULE.parse(example_data_part1[0])
+    checkpoint_path = tmp_path / "part1.checkpoint.npz"
+    frames_path = tmp_path / "part1.frames"
+
+    # stop (as if it crashed) after the third round
+    with pytest.raises(NotStableError):
+        run_with_checkpoints(
+            PART1_RULE, seat, occupied, checkpoint_path, 2, frames_path, max_rounds=3
+        )
+    assert load_checkpoint(checkpoint_path)[-1] == 2
+    assert len(FrameLog.open(frames_path)) == 4
+
+    n, occupied = run_with_checkpoints(
+        PART1_RULE, seat, occupied, checkpoint_path, 2, frames_path
+    )
+    assert n == 5
+    assert PART1_RULE.render(seat, occupied) == example_data_part1[-1]
+    assert load_checkpoint(checkpoint_path)[-1] == 5
+
+    # every round can be replayed from the log
+    frames = FrameLog.open(frames_path)
+    assert len(frames) == 6
+    for n_round, expected in enumerate(example_data_part1):
+        assert PART1_RULE.render(seat, frames.replay(n_round)) == expected
+    assert np.array_equal(frames.seat, seat)
+
+    # a half-written frame at the end is dropped
+    with open(frames_path, "ab") as ofile:
+        ofile.write(FRAME_LENGTH.pack(100) + b"abc")
+    assert len(FrameLog.open(frames_path)) == 6
+
+    # and a finished simulation resumes straight to the end
+    n, occupied = run_with_checkpoints(
+        PART1_RULE, seat, seat & False, checkpoint_path, 2
+    )
+    assert n == 5
+    assert PART1_RULE.render(seat, occupied) == example_data_part1[-1]
+
+    # the frame log cannot start part way through
+    frames_path.unlink()
+    with pytest.raises(SystemExit):
+        run_with_checkpoints(
+            PART1_RULE, seat, occupied, checkpoint_path, 2, frames_path
+        )
+    assert not frames_path.exists()
+
+
+def test_checkpoint_part2(tmp_path, example_data_part2):
+    seat, occupied = PART2_RULE.parse(example_data_part2[0])
+    n, occupied = run_with_checkpoints(
+        PART2_RULE, seat, occupied, tmp_path / "part2.checkpoint.npz", 4
+    )
+    assert n == 6
+    assert PART2_RULE.render(seat, occupied) == example_data_part2[-1]
+    with pytest.raises(SystemExit):
+        run_with_checkpoints(
+            PART1_RULE, seat, occupied, tmp_path / "part2.checkpoint.npz"
+        )
+
+
 def find_stable_configuration(seats: list, is_part1: bool) -> list:
 
     n_passes = 0
@@ -535,34 +820,1217 @@ def apply_rules(seats: list, is_part1: bool) -> list:
     return final_seat_configuration
 
 
-def main(input_path):
+def seat_masks(seats: list, cell_types: str = ".L#") -> tuple:
+    """
+    Convert the seat configuration into two boolean arrays of the
+    same shape as the layout: where the seats are (i.e. not floor),
+    and which of those are occupied. `cell_types` are the characters
+    for the floor, an empty seat, and an occupied seat.
+    """
+    floor, _, occupied = cell_types
+    layout = np.array([list(row.strip()) for row in seats if row.strip()])
+    return layout != floor, layout == occupied
+
+
+def masks_to_seats(
+    seat: np.ndarray, occupied: np.ndarray, cell_types: str = ".L#"
+) -> list:
+    """
+    Convert the seat and occupied masks back into the list of strings.
+    """
+    floor, empty, full = cell_types
+    layout = np.where(seat, np.where(occupied, full, empty), floor)
+    return ["".join(row) for row in layout]
 
-    with open(input_path, "r") as ifile:
-        input_data = [
-            [x.strip() for x in t.strip().split("\n") if x != ""] for t in ifile
+
+def count_adjacent_occupied(occupied: np.ndarray) -> np.ndarray:
+    """
+    Count the occupied seats around each position, by summing the
+    eight shifted copies of the (zero-padded) occupied mask.
+    """
+    n_rows, n_columns = occupied.shape
+    padded = np.pad(occupied.astype(np.uint8), 1)
+    counts = np.zeros(occupied.shape, dtype=np.uint8)
+    for drow in range(3):
+        for dcol in range(3):
+            if drow == 1 and dcol == 1:
+                continue
+            row_end, column_end = drow + n_rows, dcol + n_columns
+            counts += padded[drow:row_end, dcol:column_end]
+    return counts
+
+
+def apply_adjacent_rules(
+    seat: np.ndarray, occupied: np.ndarray, threshold: int = 4, birth: int = 0
+) -> np.ndarray:
+    """
+    Array version of `apply_rules` for part 1: empty seats with no more
+    than `birth` (i.e. no) occupied seats around them become occupied, and
+    occupied seats with at least `threshold` occupied seats around them
+    are emptied. Returns the new occupied mask.
+    """
+    counts = count_adjacent_occupied(occupied)
+    return seat & np.where(occupied, counts < threshold, counts <= birth)
+
+
+# not every set of rules settles down (some flip back and forth forever)
+MAX_ROUNDS = 100000
+
+
+class NotStableError(RuntimeError):
+    """
+    Raised when the seats are still changing after the maximum number
+    of rounds.
+    """
+
+    def __init__(self, max_rounds: int):
+        super().__init__(f"Seats still changing after {max_rounds} rounds")
+        self.max_rounds = max_rounds
+
+
+def find_stable_occupancy(
+    seat: np.ndarray, occupied: np.ndarray, apply, max_rounds: int = MAX_ROUNDS
+) -> tuple:
+    """
+    Same as `find_stable_configuration`, but on the occupied mask, with
+    `apply(seat, occupied)` giving the next one. `seat` is passed through
+    as is (e.g. the seat mask, or a neighbour table).
+
+    Raises `NotStableError` if the seats are still changing after
+    `max_rounds` rounds.
+    """
+    n_passes = 0
+    current = apply(seat, occupied)
+    while not np.array_equal(current, occupied):
+        n_passes += 1
+        if n_passes >= max_rounds:
+            raise NotStableError(max_rounds)
+        occupied, current = current, apply(seat, current)
+    return n_passes, current
+
+
+# the eight directions, as (row, column) steps
+DIRECTIONS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+NEIGHBOURS_SUFFIX = ".neighbours.npy"
+
+
+def seat_index_grid(seat: np.ndarray) -> np.ndarray:
+    """
+    Number the seats in row-major order, with -1 for the floor.
+    """
+    index = np.full(seat.shape, -1, dtype=np.int32)
+    index[seat] = np.arange(seat.sum(), dtype=np.int32)
+    return index
+
+
+def visible_neighbour_table(seat: np.ndarray) -> np.ndarray:
+    """
+    For each seat (numbered as in `seat_index_grid`), the index of the
+    first seat visible in each of the eight directions, or -1 if only
+    floor is seen before the edge of the layout.
+
+    Each direction is filled in one row (or column) at a time, going
+    against the direction: the first seat seen from a position is the
+    next position itself if it is a seat, or else the first seat seen
+    from the next position.
+    """
+    index = seat_index_grid(seat)
+    n_rows, n_columns = seat.shape
+    # padded with a ring of floor, so that rays end there
+    padded = np.pad(index, 1, constant_values=-1)
+    neighbours = np.full((int(seat.sum()), len(DIRECTIONS)), -1, dtype=np.int32)
+    for idirection, (drow, dcol) in enumerate(DIRECTIONS):
+        first_seen = np.full(padded.shape, -1, dtype=np.int32)
+        if drow:
+            rows = range(n_rows, 0, -1) if drow > 0 else range(1, n_rows + 1)
+            for row in rows:
+                next_row = row + drow
+                next_index = np.roll(padded[next_row], -dcol)[1:-1]
+                next_seen = np.roll(first_seen[next_row], -dcol)[1:-1]
+                first_seen[row, 1:-1] = np.where(next_index >= 0, next_index, next_seen)
+        else:
+            columns = range(n_columns, 0, -1) if dcol > 0 else range(1, n_columns + 1)
+            for col in columns:
+                next_col = col + dcol
+                next_index = padded[1:-1, next_col]
+                next_seen = first_seen[1:-1, next_col]
+                first_seen[1:-1, col] = np.where(next_index >= 0, next_index, next_seen)
+        neighbours[:, idirection] = first_seen[1:-1, 1:-1][seat]
+    return neighbours
+
+
+def load_neighbour_table(seat: np.ndarray, cache_dir=None) -> np.ndarray:
+    """
+    Get the `visible_neighbour_table` of the layout, cached in `cache_dir`
+    (if given) under a hash of the layout, since it only depends on
+    where the seats are and not on whether they are occupied.
+    """
+    if cache_dir is None:
+        return visible_neighbour_table(seat)
+    digest = hashlib.sha256(repr(seat.shape).encode())
+    digest.update(np.packbits(seat).tobytes())
+    cache_path = Path(cache_dir) / (digest.hexdigest()[:32] + NEIGHBOURS_SUFFIX)
+    if cache_path.exists():
+        return np.load(cache_path)
+    neighbours = visible_neighbour_table(seat)
+    try:
+        np.save(cache_path, neighbours)
+    except OSError as error:
+        print(f"WARNING: Could not cache neighbour table {cache_path}: {error}")
+    return neighbours
+
+
+def count_table_occupied(neighbours: np.ndarray, occupied: np.ndarray) -> np.ndarray:
+    """
+    Count the occupied neighbours of each seat, where `occupied` is
+    indexed by seat: a gather over the neighbour table, where the -1
+    padding picks out an extra (never occupied) seat at the end.
+    """
+    occupied = np.append(occupied, False).view(np.uint8)
+    dtype = np.min_scalar_type(neighbours.shape[1])
+    return occupied[neighbours].sum(axis=1, dtype=dtype)
+
+
+def apply_table_rules(
+    neighbours: np.ndarray, occupied: np.ndarray, threshold: int = 5, birth: int = 0
+) -> np.ndarray:
+    """
+    Array version of `apply_rules` for part 2, on the occupied
+    state of each seat with its neighbours given by `neighbours`.
+    """
+    counts = count_table_occupied(neighbours, occupied)
+    return np.where(occupied, counts < threshold, counts <= birth)
+
+
+def adjacent_neighbour_table(seat: np.ndarray) -> np.ndarray:
+    """
+    Same as `visible_neighbour_table`, but with only the seats right
+    next to each seat (i.e. the part 1 neighbours).
+    """
+    return radius_neighbour_table(seat, 1)
+
+
+def radius_neighbour_table(seat: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Same as `visible_neighbour_table`, but with all of the seats that are
+    at most `radius` rows and columns away from each seat.
+    """
+    n_rows, n_columns = seat.shape
+    offsets = [
+        (drow, dcol)
+        for drow in range(-radius, radius + 1)
+        for dcol in range(-radius, radius + 1)
+        if drow or dcol
+    ]
+    padded = np.pad(seat_index_grid(seat), radius, constant_values=-1)
+    neighbours = np.full((int(seat.sum()), len(offsets)), -1, dtype=np.int32)
+    for ioffset, (drow, dcol) in enumerate(offsets):
+        row, col = radius + drow, radius + dcol
+        row_end, column_end = row + n_rows, col + n_columns
+        shifted = padded[row:row_end, col:column_end]
+        neighbours[:, ioffset] = shifted[seat]
+    return neighbours
+
+
+def simulate_frontier(
+    neighbours: np.ndarray,
+    occupied: np.ndarray,
+    threshold: int,
+    report=None,
+    birth: int = 0,
+    max_rounds: int = MAX_ROUNDS,
+) -> tuple:
+    """
+    Run the rules until the seats stop changing, in the same way as
+    `find_stable_occupancy` with `apply_table_rules`, but only looking
+    at the seats that could change: a seat can only change if it, or
+    one of its neighbours, changed in the previous round (the "frontier").
+
+    The occupied neighbour counts are kept up to date by adding or
+    removing one for each neighbour of the seats that change, and the
+    configuration is stable once no seat in the frontier changes.
+    If given, `report(n_round, n_frontier, n_changed)` is called after
+    each round.
+
+    Returns the number of rounds in which seats changed, and the final
+    occupied state of each seat.
+    """
+    occupied = occupied.copy()
+    counts = count_table_occupied(neighbours, occupied).astype(np.int32)
+    frontier = np.arange(len(occupied))
+    n_round = 0
+    while True:
+        n_round += 1
+        frontier_counts = counts[frontier]
+        flips = np.where(
+            occupied[frontier],
+            frontier_counts >= threshold,
+            frontier_counts <= birth,
+        )
+        changed = frontier[flips]
+        if report is not None:
+            report(n_round, len(frontier), len(changed))
+        if not len(changed):
+            return n_round - 1, occupied
+        if n_round >= max_rounds:
+            raise NotStableError(max_rounds)
+
+        occupied[changed] = ~occupied[changed]
+        changed_neighbours = neighbours[changed]
+        deltas = np.where(occupied[changed], 1, -1).astype(np.int32)
+        deltas = np.broadcast_to(deltas[:, None], changed_neighbours.shape)
+        valid = changed_neighbours >= 0
+        np.add.at(counts, changed_neighbours[valid], deltas[valid])
+        frontier = np.unique(np.concatenate([changed, changed_neighbours[valid]]))
+
+
+def print_frontier(n_round: int, n_frontier: int, n_changed: int):
+    print(f"  round {n_round:>4}: frontier = {n_frontier:>8}, changed = {n_changed:>8}")
+
+
+def add_bitplane(planes: list, bits: int) -> None:
+    """
+    Add one to the bit-sliced counters in `planes` (bit i of each
+    counter is in planes[i]) wherever `bits` is set, rippling the
+    carry up through the planes.
+    """
+    for i, plane in enumerate(planes):
+        carry = plane & bits
+        planes[i] = plane ^ bits
+        bits = carry
+        if not bits:
+            return
+    planes.append(bits)
+
+
+def bitplanes_at_least(planes: list, n: int, ones: int) -> int:
+    """
+    The bits where the bit-sliced counters in `planes` are at least `n`,
+    comparing one bit at a time from the lowest (`ones` has every bit
+    of interest set).
+    """
+    if n >> len(planes):
+        return 0
+    at_least = ones
+    for i, plane in enumerate(planes):
+        if (n >> i) & 1:
+            at_least &= plane
+        else:
+            at_least |= plane
+    return at_least
+
+
+class SeatBitboard:
+    """
+    The seat layout as two bitboards stored in python ints, one for where
+    the seats are and one for which of them are occupied. Bit
+    `row * stride + col` is the seat at (row, col), and each row has an
+    extra always-empty column at the end, so that shifting a bitboard
+    by one column never moves a seat into the neighbouring row.
+
+    The eight neighbours are then eight shifts of the occupied bitboard,
+    which are added up bit-sliced (SWAR), and the rules are applied to
+    every seat at once with a handful of bitwise operations.
+    """
+
+    def __init__(self, width: int, height: int, seat: int, occupied: int):
+        self.width = width
+        self.height = height
+        self.stride = width + 1
+        self.seat = seat
+        self.occupied = occupied
+
+    @staticmethod
+    def mask_to_int(mask: np.ndarray) -> int:
+        padded = np.pad(mask, ((0, 0), (0, 1)))
+        return int.from_bytes(
+            np.packbits(padded, bitorder="little").tobytes(), "little"
+        )
+
+    def int_to_mask(self, bits: int) -> np.ndarray:
+        n_bits = self.height * self.stride
+        data = np.frombuffer(bits.to_bytes((n_bits + 7) // 8, "little"), np.uint8)
+        unpacked = np.unpackbits(data, count=n_bits, bitorder="little").astype(bool)
+        return unpacked.reshape(self.height, self.stride)[:, : self.width]
+
+    @classmethod
+    def from_masks(cls, seat: np.ndarray, occupied: np.ndarray):
+        height, width = seat.shape
+        return cls(width, height, cls.mask_to_int(seat), cls.mask_to_int(occupied))
+
+    @classmethod
+    def from_seats(cls, seats: list):
+        return cls.from_masks(*seat_masks(seats))
+
+    def to_masks(self) -> tuple:
+        return self.int_to_mask(self.seat), self.int_to_mask(self.occupied)
+
+    def to_seats(self) -> list:
+        return masks_to_seats(*self.to_masks())
+
+    def n_occupied(self) -> int:
+        return bin(self.occupied).count("1")
+
+    def neighbour_planes(self) -> list:
+        """
+        The bit-sliced counts of the occupied neighbours of every position.
+        """
+        occupied, stride = self.occupied, self.stride
+        planes = []
+        for shift in [1, stride - 1, stride, stride + 1]:
+            add_bitplane(planes, occupied << shift)
+            add_bitplane(planes, occupied >> shift)
+        return planes
+
+    def step(self, threshold: int = 4, birth: int = 0):
+        """
+        One round of the part 1 rules, as `apply_adjacent_rules`.
+        """
+        planes = self.neighbour_planes()
+        seat, occupied = self.seat, self.occupied
+        crowded = bitplanes_at_least(planes, threshold, seat)
+        lonely = ~bitplanes_at_least(planes, birth + 1, seat)
+        occupied = (occupied & ~crowded | ~occupied & lonely) & seat
+        return SeatBitboard(self.width, self.height, seat, occupied)
+
+    def run_until_stable(
+        self, threshold: int = 4, birth: int = 0, max_rounds: int = MAX_ROUNDS
+    ) -> tuple:
+        """
+        Same as `find_stable_occupancy`, returning the number of rounds in
+        which seats changed and the stable bitboard.
+        """
+        n_passes = 0
+        board, current = self, self.step(threshold, birth)
+        while current.occupied != board.occupied:
+            n_passes += 1
+            if n_passes >= max_rounds:
+                raise NotStableError(max_rounds)
+            board, current = current, current.step(threshold, birth)
+        return n_passes, current
+
+
+class SharedArrays:
+    """
+    Numpy arrays backed by `multiprocessing.shared_memory` blocks, which
+    other processes can attach to by passing them `specs()`.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.arrays = []
+
+    def create(self, shape, dtype) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self.blocks.append(block)
+        self.arrays.append(np.ndarray(shape, dtype, buffer=block.buf))
+        return self.arrays[-1]
+
+    def specs(self) -> list:
+        return [
+            (block.name, array.shape, array.dtype.str)
+            for block, array in zip(self.blocks, self.arrays)
         ]
 
-    # part 1
-    n_iterations, stable_configuration_part1 = find_stable_configuration(
-        input_data, True
+    @classmethod
+    def attach(cls, specs: list):
+        shared = cls()
+        for name, shape, dtype in specs:
+            block = shared_memory.SharedMemory(name=name)
+            shared.blocks.append(block)
+            shared.arrays.append(np.ndarray(shape, dtype, buffer=block.buf))
+        return shared
+
+    def close(self, unlink: bool = False):
+        self.arrays.clear()
+        for block in self.blocks:
+            try:
+                block.close()
+            except BufferError:
+                # still referenced from a frame (e.g. in a traceback)
+                pass
+            if unlink:
+                block.unlink()
+        self.blocks.clear()
+
+
+def run_band(
+    specs: list,
+    first: int,
+    end: int,
+    iworker: int,
+    threshold: int,
+    birth: int,
+    max_rounds: int,
+    barrier,
+):
+    """
+    Worker for `simulate_shared`: runs the rules on the seats in
+    [first, end) until no seat changes, in step with the other workers.
+    """
+    shared = SharedArrays.attach(specs)
+    try:
+        n_rounds = run_band_rounds(
+            shared.arrays, first, end, iworker, threshold, birth, max_rounds, barrier
+        )
+        if iworker == 0:
+            shared.arrays[3][0] = n_rounds
+    finally:
+        shared.close()
+
+
+def run_band_rounds(
+    arrays: list,
+    first: int,
+    end: int,
+    iworker: int,
+    threshold: int,
+    birth: int,
+    max_rounds: int,
+    barrier,
+) -> int:
+    """
+    Each round reads the occupied seats from one buffer and writes its
+    band of seats to the other, and then waits at the barrier for the
+    other bands, after which the buffers swap. Whether a band changed
+    is flagged per round parity, so the flags of a round can still be
+    read while the next round is setting its own.
+
+    Returns the number of rounds in which seats changed, or -1 if they
+    were still changing after `max_rounds` rounds (all of the workers
+    see the same flags, so they all stop at the same round).
+    """
+    neighbours, buffers, changed, _ = arrays
+    band = neighbours[first:end]
+    dtype = np.min_scalar_type(neighbours.shape[1])
+    n_round = 0
+    while True:
+        parity = n_round % 2
+        current, following = buffers[parity], buffers[1 - parity]
+        counts = current[band].sum(axis=1, dtype=dtype)
+        band_occupied = current[first:end].astype(bool)
+        band_following = np.where(band_occupied, counts < threshold, counts <= birth)
+        following[first:end] = band_following
+        changed[parity, iworker] = (band_following != band_occupied).any()
+        barrier.wait()
+        if not changed[parity].any():
+            return n_round
+        n_round += 1
+        if n_round >= max_rounds:
+            return -1
+
+
+def simulate_shared(
+    neighbours: np.ndarray,
+    occupied: np.ndarray,
+    threshold: int,
+    n_workers=None,
+    birth: int = 0,
+    max_rounds: int = MAX_ROUNDS,
+) -> tuple:
+    """
+    Run the rules until the seats stop changing, in the same way as
+    `find_stable_occupancy` with `apply_table_rules`, with the seats split
+    into `n_workers` bands of consecutive seats (i.e. horizontal bands of
+    the layout), each one updated by its own process.
+
+    The neighbour table and the two occupied buffers are in shared memory,
+    so that the bands can read the seats of any other band: through the
+    neighbour table, the line-of-sight neighbours of part 2 do not need
+    any halo of rows around the band.
+
+    Returns the number of rounds in which seats changed, and the final
+    occupied state of each seat.
+    """
+    n_workers = max(1, min(n_workers or os.cpu_count(), len(occupied)))
+    shared = SharedArrays()
+    try:
+        return run_bands(
+            shared, neighbours, occupied, threshold, birth, max_rounds, n_workers
+        )
+    finally:
+        shared.close(unlink=True)
+
+
+def run_bands(
+    shared: SharedArrays,
+    neighbours: np.ndarray,
+    occupied: np.ndarray,
+    threshold: int,
+    birth: int,
+    max_rounds: int,
+    n_workers: int,
+) -> tuple:
+    """
+    Set up the shared arrays for `simulate_shared` and run the workers
+    over them (in this process if there is only one).
+    """
+    n_seats = len(occupied)
+    shared.create(neighbours.shape, np.int32)[:] = neighbours
+    # the extra (never occupied) seat at the end is where -1 points to
+    buffers = shared.create((2, n_seats + 1), np.uint8)
+    buffers[:] = 0
+    buffers[0, :n_seats] = occupied
+    shared.create((2, n_workers), np.uint8)
+    n_rounds = shared.create((1,), np.int64)
+
+    barrier = multiprocessing.Barrier(n_workers)
+    if n_workers == 1:
+        n_rounds[0] = run_band_rounds(
+            shared.arrays, 0, n_seats, 0, threshold, birth, max_rounds, barrier
+        )
+    else:
+        bounds = np.linspace(0, n_seats, n_workers + 1).astype(int).tolist()
+        processes = [
+            multiprocessing.Process(
+                target=run_band,
+                args=(
+                    shared.specs(),
+                    first,
+                    end,
+                    iworker,
+                    threshold,
+                    birth,
+                    max_rounds,
+                    barrier,
+                ),
+            )
+            for iworker, (first, end) in enumerate(zip(bounds, bounds[1:]))
+        ]
+        for process in processes:
+            process.start()
+        pending = {process.sentinel: process for process in processes}
+        failed = False
+        while pending:
+            for sentinel in wait(list(pending)):
+                process = pending.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    # release the workers that are waiting on this one
+                    failed = True
+                    barrier.abort()
+        if failed:
+            print("ERROR: A seat simulation worker failed")
+            sys.exit(1)
+
+    n_passes = int(n_rounds[0])
+    if n_passes < 0:
+        raise NotStableError(max_rounds)
+    return n_passes, buffers[n_passes % 2, :n_seats].astype(bool)
+
+
+def count_occupied_within(occupied: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Count the occupied seats that are at most `radius` rows and columns
+    away from each position, from the summed-area table of the
+    (zero-padded) occupied mask, so that the cost does not depend on
+    the radius.
+    """
+    size = 2 * radius + 1
+    padded = np.pad(occupied.astype(np.int32), (radius + 1, radius))
+    sums = padded.cumsum(axis=0).cumsum(axis=1)
+    counts = sums[size:, size:] - sums[:-size, size:]
+    counts -= sums[size:, :-size] - sums[:-size, :-size]
+    return counts - occupied
+
+
+def apply_radius_rules(
+    seat: np.ndarray,
+    occupied: np.ndarray,
+    radius: int = 1,
+    threshold: int = 4,
+    birth: int = 0,
+) -> np.ndarray:
+    """
+    Same as `apply_adjacent_rules`, counting all of the occupied seats
+    that are at most `radius` rows and columns away.
+    """
+    counts = count_occupied_within(occupied, radius)
+    return seat & np.where(occupied, counts < threshold, counts <= birth)
+
+
+ADJACENT = "adjacent"
+LINE_OF_SIGHT = "line-of-sight"
+RADIUS = "radius"
+NEIGHBOURHOODS = [ADJACENT, LINE_OF_SIGHT, RADIUS]
+ENGINES = ["vectorized", "frontier", "bitboard", "shared"]
+
+
+class SeatRule:
+    """
+    A specification of how the seats fill up and empty out:
+
+        neighbourhood: which seats count as the neighbours of a seat,
+            either the ones right next to it (ADJACENT), the first one
+            seen in each direction (LINE_OF_SIGHT), or all of the ones at
+            most `radius` rows and columns away (RADIUS)
+        birth: an empty seat becomes occupied if at most this many of
+            its neighbours are occupied
+        death: an occupied seat is emptied if at least this many of its
+            neighbours are occupied
+        cell_types: the characters for the floor, an empty seat, and an
+            occupied seat
+
+    `compile` turns the rule into a simulation on one of the engines above.
+    """
+
+    def __init__(
+        self,
+        neighbourhood: str = ADJACENT,
+        birth: int = 0,
+        death: int = 4,
+        radius: int = 1,
+        cell_types: str = ".L#",
+    ):
+        if neighbourhood not in NEIGHBOURHOODS:
+            print(f"ERROR: Unknown seat neighbourhood: {neighbourhood}")
+            sys.exit(1)
+        if radius < 1:
+            print(f"ERROR: Invalid seat neighbourhood radius: {radius}")
+            sys.exit(1)
+        if len(cell_types) != 3 or len(set(cell_types)) != 3:
+            print(f"ERROR: Expected three different cell types, got '{cell_types}'")
+            sys.exit(1)
+        self.neighbourhood = neighbourhood
+        self.radius = 1 if neighbourhood == ADJACENT else radius
+        self.birth = birth
+        self.death = death
+        self.cell_types = cell_types
+
+    def __repr__(self):
+        return (
+            f"SeatRule({self.neighbourhood!r}, birth={self.birth}, "
+            f"death={self.death}, radius={self.radius}, cell_types={self.cell_types!r})"
+        )
+
+    def parse(self, seats: list) -> tuple:
+        return seat_masks(seats, self.cell_types)
+
+    def render(self, seat: np.ndarray, occupied: np.ndarray) -> list:
+        return masks_to_seats(seat, occupied, self.cell_types)
+
+    def default_engine(self) -> str:
+        """
+        The fastest engine for the rule: bitboards for the adjacent seats,
+        the frontier for the line of sight (which goes through a neighbour
+        table anyway), and the summed-area counts for larger radii.
+        """
+        if self.neighbourhood == LINE_OF_SIGHT:
+            return "frontier"
+        if self.radius == 1:
+            return "bitboard"
+        return "vectorized"
+
+    def can_run(self, engine: str) -> bool:
+        """
+        Whether the rule can run on `engine` (the bitboards only know
+        about the adjacent seats).
+        """
+        if engine == "bitboard":
+            return self.neighbourhood != LINE_OF_SIGHT and self.radius == 1
+        return engine in ENGINES
+
+    def neighbour_table(self, seat: np.ndarray, cache_dir=None) -> np.ndarray:
+        if self.neighbourhood == LINE_OF_SIGHT:
+            return load_neighbour_table(seat, cache_dir)
+        return radius_neighbour_table(seat, self.radius)
+
+    def compile(
+        self,
+        seat: np.ndarray,
+        engine: str = None,
+        n_workers: int = None,
+        cache_dir=None,
+        report=None,
+        max_rounds: int = MAX_ROUNDS,
+    ):
+        """
+        Build the simulation of the rule on the layout with seats at `seat`,
+        on the given `engine` (or the `default_engine`). The simulation
+        takes the starting occupied mask and returns the number of rounds
+        in which seats changed and the stable occupied mask, like
+        `find_stable_occupancy`.
+
+        `n_workers` is for the "shared" engine, `cache_dir` is where the
+        line-of-sight neighbour table is cached, and `report` is called
+        after each round of the "frontier" engine. The simulation raises
+        `NotStableError` if the seats are still changing after `max_rounds`
+        rounds.
+        """
+        engine = engine or self.default_engine()
+        if engine not in ENGINES:
+            print(f"ERROR: Unknown seat simulation engine: {engine}")
+            sys.exit(1)
+        if not self.can_run(engine):
+            print(f"ERROR: The {engine} engine cannot run {self}")
+            sys.exit(1)
+
+        if engine == "bitboard":
+
+            def simulate_bitboard(occupied: np.ndarray) -> tuple:
+                board = SeatBitboard.from_masks(seat, occupied)
+                n_passes, board = board.run_until_stable(
+                    self.death, self.birth, max_rounds
+                )
+                return n_passes, board.to_masks()[1]
+
+            return simulate_bitboard
+
+        if engine == "vectorized" and self.neighbourhood != LINE_OF_SIGHT:
+            apply = functools.partial(
+                apply_radius_rules,
+                radius=self.radius,
+                threshold=self.death,
+                birth=self.birth,
+            )
+            return functools.partial(
+                find_stable_occupancy, seat, apply=apply, max_rounds=max_rounds
+            )
+
+        # the others run on the occupied state of each seat
+        neighbours = self.neighbour_table(seat, cache_dir)
+        if engine == "vectorized":
+            apply = functools.partial(
+                apply_table_rules, threshold=self.death, birth=self.birth
+            )
+            simulate = functools.partial(
+                find_stable_occupancy, neighbours, apply=apply, max_rounds=max_rounds
+            )
+        elif engine == "frontier":
+            simulate = functools.partial(
+                simulate_frontier,
+                neighbours,
+                threshold=self.death,
+                report=report,
+                birth=self.birth,
+                max_rounds=max_rounds,
+            )
+        else:
+            simulate = functools.partial(
+                simulate_shared,
+                neighbours,
+                threshold=self.death,
+                n_workers=n_workers,
+                birth=self.birth,
+                max_rounds=max_rounds,
+            )
+
+        def simulate_seats(occupied: np.ndarray) -> tuple:
+            n_passes, occupied_seats = simulate(occupied[seat])
+            occupied = np.zeros_like(seat)
+            occupied[seat] = occupied_seats
+            return n_passes, occupied
+
+        return simulate_seats
+
+    def step_function(self, seat: np.ndarray, cache_dir=None):
+        """
+        A single round of the rule on the layout with seats at `seat`,
+        as a function from one occupied mask to the next.
+        """
+        if self.neighbourhood != LINE_OF_SIGHT:
+            return functools.partial(
+                apply_radius_rules,
+                seat,
+                radius=self.radius,
+                threshold=self.death,
+                birth=self.birth,
+            )
+        neighbours = self.neighbour_table(seat, cache_dir)
+
+        def step_seats(occupied: np.ndarray) -> np.ndarray:
+            following = np.zeros_like(seat)
+            following[seat] = apply_table_rules(
+                neighbours, occupied[seat], self.death, self.birth
+            )
+            return following
+
+        return step_seats
+
+    def run(self, seats: list, engine: str = None, **kwargs) -> tuple:
+        """
+        Run the rule on the seat configuration `seats` until it is stable,
+        returning the number of rounds in which seats changed and the
+        stable configuration.
+        """
+        seat, occupied = self.parse(seats)
+        n_passes, occupied = self.compile(seat, engine, **kwargs)(occupied)
+        return n_passes, self.render(seat, occupied)
+
+
+PART1_RULE = SeatRule(ADJACENT, death=4)
+PART2_RULE = SeatRule(LINE_OF_SIGHT, death=5)
+
+
+def time_engines(rule: SeatRule, seats: list, engines: list = None, **kwargs) -> dict:
+    """
+    Time the simulation of `rule` on `seats` with each of the `engines`
+    (all of the ones that can run the rule by default), giving the
+    seconds taken, the number of rounds, and the number of occupied seats.
+    The last two are None if the seats never settled down.
+    """
+    if engines is None:
+        engines = [engine for engine in ENGINES if rule.can_run(engine)]
+    seat, occupied = rule.parse(seats)
+    timings = {}
+    for engine in engines:
+        start = time.perf_counter()
+        simulate = rule.compile(seat, engine, **kwargs)
+        try:
+            n_passes, stable = simulate(occupied)
+            n_occupied = int(stable.sum())
+        except NotStableError:
+            n_passes, n_occupied = None, None
+        timings[engine] = (time.perf_counter() - start, n_passes, n_occupied)
+    return timings
+
+
+def pack_mask(mask: np.ndarray) -> bytes:
+    return np.packbits(mask).tobytes()
+
+
+def unpack_mask(data: bytes, shape: tuple) -> np.ndarray:
+    n_bits = shape[0] * shape[1]
+    bits = np.unpackbits(np.frombuffer(data, np.uint8), count=n_bits)
+    return bits.astype(bool).reshape(shape)
+
+
+def save_checkpoint(
+    checkpoint_path, rule: SeatRule, seat: np.ndarray, occupied: np.ndarray, n_round
+):
+    """
+    Save the bit-packed seat and occupied masks after `n_round` rounds of
+    `rule`. The checkpoint is written next to `checkpoint_path` first and
+    then moved into place, so that a crash while saving leaves the
+    previous checkpoint as it was.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    partial_path = checkpoint_path.with_name(checkpoint_path.name + ".partial")
+    with open(partial_path, "wb") as ofile:
+        np.savez(
+            ofile,
+            rule=repr(rule),
+            shape=np.array(seat.shape),
+            seat=np.frombuffer(pack_mask(seat), np.uint8),
+            occupied=np.frombuffer(pack_mask(occupied), np.uint8),
+            n_round=n_round,
+        )
+    os.replace(partial_path, checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path) -> tuple:
+    """
+    Load a checkpoint saved with `save_checkpoint`, returning the rule
+    (as its repr), the seat and occupied masks, and the number of rounds.
+    """
+    with np.load(checkpoint_path) as checkpoint:
+        shape = tuple(checkpoint["shape"].tolist())
+        seat = unpack_mask(checkpoint["seat"].tobytes(), shape)
+        occupied = unpack_mask(checkpoint["occupied"].tobytes(), shape)
+        return str(checkpoint["rule"]), seat, occupied, int(checkpoint["n_round"])
+
+
+# magic, version, number of rows and columns, then the compressed seat mask
+FRAMES_HEADER = struct.Struct("<4sHII")
+FRAMES_MAGIC = b"SEAT"
+FRAMES_VERSION = 1
+# each frame is its compressed length followed by the compressed data
+FRAME_LENGTH = struct.Struct("<I")
+
+
+class FrameLog:
+    """
+    A log of every round of a simulation: the first frame is the bit-packed
+    starting occupied mask, and each frame after that is the XOR of the
+    packed occupied masks before and after a round, compressed with zlib.
+    Late in a simulation only a few seats change, so the XOR is mostly
+    zeros and compresses down to almost nothing.
+
+    Any round can be replayed by XOR-ing the frames up to it.
+    """
+
+    def __init__(self, log_path, shape: tuple, seat: np.ndarray, offsets: list):
+        self.log_path = Path(log_path)
+        self.shape = shape
+        self.seat = seat
+        # where each frame starts in the file, and where the last one ends
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def create(cls, log_path, seat: np.ndarray, occupied: np.ndarray):
+        shape = seat.shape
+        with open(log_path, "wb") as ofile:
+            ofile.write(FRAMES_HEADER.pack(FRAMES_MAGIC, FRAMES_VERSION, *shape))
+            packed_seat = zlib.compress(pack_mask(seat))
+            ofile.write(FRAME_LENGTH.pack(len(packed_seat)) + packed_seat)
+            start = ofile.tell()
+        frames = cls(log_path, shape, seat, [start])
+        frames.append(pack_mask(occupied))
+        return frames
+
+    @classmethod
+    def open(cls, log_path):
+        """
+        Open an existing log, dropping a frame that was only partly written.
+        """
+        with open(log_path, "rb") as ifile:
+            header = ifile.read(FRAMES_HEADER.size)
+            if len(header) != FRAMES_HEADER.size:
+                print(f"ERROR: {log_path} is not a seat frame log")
+                sys.exit(1)
+            magic, version, n_rows, n_columns = FRAMES_HEADER.unpack(header)
+            if magic != FRAMES_MAGIC or version != FRAMES_VERSION:
+                print(f"ERROR: {log_path} is not a seat frame log")
+                sys.exit(1)
+            shape = (n_rows, n_columns)
+            (length,) = FRAME_LENGTH.unpack(ifile.read(FRAME_LENGTH.size))
+            seat = unpack_mask(zlib.decompress(ifile.read(length)), shape)
+            offsets = [ifile.tell()]
+            while True:
+                prefix = ifile.read(FRAME_LENGTH.size)
+                if len(prefix) != FRAME_LENGTH.size:
+                    break
+                (length,) = FRAME_LENGTH.unpack(prefix)
+                if len(ifile.read(length)) != length:
+                    break
+                offsets.append(ifile.tell())
+        frames = cls(log_path, shape, seat, offsets)
+        frames.truncate(len(frames))
+        return frames
+
+    def append(self, packed: bytes):
+        data = zlib.compress(packed)
+        with open(self.log_path, "ab") as ofile:
+            ofile.write(FRAME_LENGTH.pack(len(data)) + data)
+            self.offsets.append(ofile.tell())
+
+    def append_round(self, occupied: np.ndarray, following: np.ndarray):
+        self.append(pack_mask(occupied ^ following))
+
+    def truncate(self, n_frames: int):
+        """
+        Keep only the first `n_frames` frames.
+        """
+        end = n_frames + 1
+        del self.offsets[end:]
+        with open(self.log_path, "r+b") as ofile:
+            ofile.truncate(self.offsets[-1])
+
+    def iter_rounds(self):
+        """
+        Generator over the occupied masks after each round, starting with
+        the masks before the first round.
+        """
+        n_bytes = (self.shape[0] * self.shape[1] + 7) // 8
+        packed = np.zeros(n_bytes, np.uint8)
+        with open(self.log_path, "rb") as ifile:
+            ifile.seek(self.offsets[0])
+            for _ in range(len(self)):
+                (length,) = FRAME_LENGTH.unpack(ifile.read(FRAME_LENGTH.size))
+                packed ^= np.frombuffer(zlib.decompress(ifile.read(length)), np.uint8)
+                yield unpack_mask(packed.tobytes(), self.shape)
+
+    def replay(self, n_round: int) -> np.ndarray:
+        """
+        The occupied mask after `n_round` rounds.
+        """
+        if not 0 <= n_round < len(self):
+            print(f"ERROR: Round {n_round} is not in {self.log_path}")
+            sys.exit(1)
+        for occupied in itertools.islice(self.iter_rounds(), n_round, None):
+            return occupied
+
+
+def run_with_checkpoints(
+    rule: SeatRule,
+    seat: np.ndarray,
+    occupied: np.ndarray,
+    checkpoint_path,
+    checkpoint_every: int = 100,
+    frames_path=None,
+    cache_dir=None,
+    max_rounds: int = MAX_ROUNDS,
+) -> tuple:
+    """
+    Run `rule` one round at a time until the seats stop changing, saving
+    a checkpoint to `checkpoint_path` every `checkpoint_every` rounds
+    (and at the end). If there is already a checkpoint there for the same
+    rule and layout, the simulation resumes from it instead of starting
+    over. If `frames_path` is given, every round is also logged to a
+    `FrameLog` there; a resumed simulation needs the log that was written
+    up to the checkpoint, since replaying starts from the first round.
+
+    Returns the number of rounds in which seats changed and the stable
+    occupied mask, like `find_stable_occupancy`.
+    """
+    n_round = 0
+    if Path(checkpoint_path).exists():
+        saved_rule, saved_seat, saved_occupied, n_round = load_checkpoint(
+            checkpoint_path
+        )
+        if saved_rule != repr(rule) or not np.array_equal(saved_seat, seat):
+            print(f"ERROR: {checkpoint_path} is a checkpoint of another simulation")
+            sys.exit(1)
+        occupied = saved_occupied
+
+    frames = None
+    if frames_path is not None:
+        if n_round:
+            if not Path(frames_path).exists():
+                print(f"ERROR: {frames_path} is missing the rounds up to {n_round}")
+                sys.exit(1)
+            # the log may have gone on past the checkpoint before stopping
+            frames = FrameLog.open(frames_path)
+            if len(frames) <= n_round:
+                print(f"ERROR: {frames_path} stops before round {n_round}")
+                sys.exit(1)
+            frames.truncate(n_round + 1)
+        else:
+            frames = FrameLog.create(frames_path, seat, occupied)
+
+    step = rule.step_function(seat, cache_dir)
+    while True:
+        following = step(occupied)
+        if np.array_equal(following, occupied):
+            break
+        if n_round >= max_rounds:
+            raise NotStableError(max_rounds)
+        n_round += 1
+        if frames is not None:
+            frames.append_round(occupied, following)
+        occupied = following
+        if n_round % checkpoint_every == 0:
+            save_checkpoint(checkpoint_path, rule, seat, occupied, n_round)
+    save_checkpoint(checkpoint_path, rule, seat, occupied, n_round)
+    return n_round, occupied
+
+
+def checkpointed(rule: SeatRule, seat: np.ndarray, checkpoint_dir, name: str, **kwargs):
+    """
+    The simulation of `rule` with `run_with_checkpoints`, keeping the
+    checkpoint (and the frame log, if `log_frames`) in `checkpoint_dir`.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    frames_path = (
+        checkpoint_dir / f"{name}.frames" if kwargs.pop("log_frames") else None
+    )
+    return functools.partial(
+        run_with_checkpoints,
+        rule,
+        seat,
+        checkpoint_path=checkpoint_dir / f"{name}.checkpoint.npz",
+        frames_path=frames_path,
+        **kwargs,
     )
+
+
+def main(
+    input_path,
+    frontier=False,
+    n_workers=None,
+    engine=None,
+    checkpoint_dir=None,
+    log_frames=False,
+):
+
+    with open(input_path, "r") as ifile:
+        input_data = [x.strip() for x in ifile if x.strip()]
+
+    if n_workers:
+        engine = "shared"
+    elif frontier:
+        engine = "frontier"
+    report = print_frontier if frontier else None
+
+    # part 1
+    seat, occupied = PART1_RULE.parse(input_data)
+    if checkpoint_dir:
+        # checkpoints are saved between rounds, so always one round at a time
+        simulate = checkpointed(
+            PART1_RULE, seat, checkpoint_dir, "part1", log_frames=log_frames
+        )
+    else:
+        part1_engine = engine if PART1_RULE.can_run(engine) else None
+        simulate = PART1_RULE.compile(seat, part1_engine, n_workers, report=report)
+    n_iterations, stable_occupied = simulate(occupied)
     print(f"PART 1: stable configuration found in {n_iterations} iterations")
-    n_occupied = n_occupied_seats_in_configuration(stable_configuration_part1)
+    n_occupied = int(stable_occupied.sum())
     print(f"PART 1: number of occupied seats in stable configuration: {n_occupied}")
 
-    n_iterations_2, stable_configuration_part2 = find_stable_configuration(
-        input_data, False
-    )
-    n_occupied = n_occupied_seats_in_configuration(stable_configuration_part2)
+    # part 2
+    cache_dir = Path(input_path).parent
+    # e.g. the bitboards cannot see past the adjacent seats
+    if checkpoint_dir:
+        simulate = checkpointed(
+            PART2_RULE,
+            seat,
+            checkpoint_dir,
+            "part2",
+            log_frames=log_frames,
+            cache_dir=cache_dir,
+        )
+    else:
+        part2_engine = engine if PART2_RULE.can_run(engine) else None
+        simulate = PART2_RULE.compile(seat, part2_engine, n_workers, cache_dir, report)
+    _, stable_occupied = simulate(occupied)
+    n_occupied = int(stable_occupied.sum())
     print(f"PART 2: number of occupied seats in stable configuration: {n_occupied}")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="AoC day #11")
     parser.add_argument("input", help="Day #11 input file")
+    parser.add_argument(
+        "--frontier",
+        action="store_true",
+        help="Only update the seats next to ones that changed, and print the number of them each round",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Split the seats into this many bands, each updated by its own process",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=None,
+        help="Seat simulation engine (by default, or if it cannot run the rules of a part, the fastest one for each part)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="Directory to save checkpoints to (and resume from) every 100 rounds",
+    )
+    parser.add_argument(
+        "--frames",
+        action="store_true",
+        help="Also log every round to a replayable frame log next to the checkpoints",
+    )
     args = parser.parse_args()
+    if args.frames and not args.checkpoint:
+        print("ERROR: --frames needs a --checkpoint directory")
+        sys.exit(1)
+    if args.checkpoint and (args.engine or args.workers or args.frontier):
+        print(
+            "ERROR: --checkpoint runs one round at a time and cannot be combined with --engine, --workers or --frontier"
+        )
+        sys.exit(1)
     input_path = Path(args.input)
     if not input_path.exists():
         print(f"ERROR: bad input '{args.input}'")
         sys.exit(1)
-    main(input_path)
+    main(
+        input_path,
+        args.frontier,
+        args.workers,
+        args.engine,
+        args.checkpoint,
+        args.frames,
+    )
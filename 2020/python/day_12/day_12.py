@@ -9,6 +9,7 @@
 #
 
 import sys
+import time
 from argparse import ArgumentParser
 from pathlib import Path
 
@@ -80,6 +81,100 @@ def test_example_1_distance(example_instructions):
     assert sum([abs(x) for x in ship.state[:2]]) == 286
 
 
+def test_parse_instructions(example_instructions):
+    opcodes, magnitudes = parse_instructions("\n".join(example_instructions) + "\n")
+    assert "".join(OPCODES[x] for x in opcodes) == "FNFRF"
+    assert magnitudes.tolist() == [10, 3, 7, 90, 11]
+    opcodes, magnitudes = parse_instructions(b"  N1\r\nR270\n\nF123456789")
+    assert opcodes.tolist() == [OP_N, OP_R, OP_F]
+    assert magnitudes.tolist() == [1, 270, 123456789]
+    with pytest.raises(SystemExit):
+        parse_instructions("N1\nX2\n")
+    with pytest.raises(SystemExit):
+        parse_instructions("N1\nF\n")
+
+    # too long for int64, so parsed (and navigated) as python ints
+    big = 10 ** 30 + 7
+    opcodes, magnitudes = parse_instructions(f"F{big}\nR{90 * big}\nN2\nF1\n")
+    assert magnitudes.tolist() == [big, 90 * big, 2, 1]
+    # big is 3 modulo 4, so turning right by 90 * big degrees faces north
+    assert navigate_heading(opcodes, magnitudes) == (big, 3, 90)
+    assert navigate_waypoint(opcodes, magnitudes) == (10 * big - 1, big + 12, -1, 12)
+    assert parse_instructions("F999999999999999999")[1].tolist() == [10 ** 18 - 1]
+
+
+def test_navigate_examples(example_instructions):
+    route = parse_instructions("\n".join(example_instructions))
+    assert navigate_heading(*route) == (17, -8, 270)
+    assert navigate_waypoint(*route) == (214, -72, 4, -10)
+    with pytest.raises(SystemExit):
+        navigate_heading(*parse_instructions("R45\nF1"))
+
+
+def test_navigate_random_route():
+    opcodes, magnitudes = random_route(2000, seed=12)
+    instructions = [f"{OPCODES[op]}{mag}" for op, mag in zip(opcodes, magnitudes)]
+    ship = Ship()
+    for instruction in instructions:
+        advance_ship_part1(ship, instruction)
+    assert navigate_heading(opcodes, magnitudes) == tuple(ship.state.astype(int))
+    ship = Ship()
+    for instruction in instructions:
+        advance_ship_part2(ship, instruction)
+    assert navigate_waypoint(opcodes, magnitudes) == tuple(
+        ship.state[:2].astype(int)
+    ) + tuple(ship.waypoint)
+
+
+def test_navigate_exact():
+    # large enough that int64 (and float) would overflow
+    opcodes = np.array([OP_N, OP_F, OP_F], dtype=np.uint8)
+    magnitudes = np.array([2 ** 40, 2 ** 40, 2 ** 40])
+    x, y, wx, wy = navigate_waypoint(opcodes, magnitudes)
+    assert (x, y) == (20 * 2 ** 40, 2 * (2 ** 40 + 1) * 2 ** 40)
+    assert (wx, wy) == (10, 2 ** 40 + 1)
+
+
+def test_fleet(example_instructions):
+    routes = [parse_instructions("\n".join(example_instructions))]
+    routes += [random_route(n, seed=n) for n in [0, 1, 50, 300, 299]]
+    expected_heading = [navigate_heading(*route) for route in routes]
+    expected_waypoint = [navigate_waypoint(*route) for route in routes]
+    for run in [run_fleet_padded, run_fleet_grouped]:
+        fleet = run(routes)
+        assert fleet.state.shape == (len(routes), 2)
+        assert fleet.state.tolist() == [list(x[:2]) for x in expected_heading]
+        assert (fleet.heading * 90).tolist() == [x[2] for x in expected_heading]
+        assert fleet.manhattan_distances().tolist() == [
+            abs(x) + abs(y) for x, y, _ in expected_heading
+        ]
+        fleet = run(routes, use_waypoint=True)
+        assert fleet.state.tolist() == [list(x[:2]) for x in expected_waypoint]
+        assert fleet.waypoint.tolist() == [list(x[2:]) for x in expected_waypoint]
+
+    # one route with magnitudes too long for int64
+    big = 10 ** 30 + 7
+    routes = routes[:2] + [parse_instructions(f"F{big}\nR{90 * big}\nN2\nF1")]
+    for run in [run_fleet_padded, run_fleet_grouped]:
+        fleet = run(routes)
+        assert fleet.state.tolist() == [
+            list(navigate_heading(*route)[:2]) for route in routes
+        ]
+        assert fleet.manhattan_distances().tolist()[-1] == big + 3
+        fleet = run(routes, use_waypoint=True)
+        assert fleet.state.tolist() == [
+            list(navigate_waypoint(*route)[:2]) for route in routes
+        ]
+
+
+def test_pad_routes():
+    routes = [random_route(n, seed=n) for n in [3, 0, 5]]
+    opcodes, magnitudes = pad_routes(routes)
+    assert opcodes.shape == magnitudes.shape == (5, 3)
+    assert (opcodes[3:, 0] == OP_NONE).all() and (opcodes[:, 1] == OP_NONE).all()
+    assert opcodes[:, 2].tolist() == routes[2][0].tolist()
+
+
 def advance_ship_part1(ship: Ship, instruction: str):
     """
     Advances the orientation and/or position of the input ship
@@ -148,36 +243,402 @@ def advance_ship_part2(ship: Ship, instruction: str):
         ship.state += [unit_x * magnitude, unit_y * magnitude, 0]
 
 
+# the instructions, numbered in the order of this string
+OPCODES = "NSEWLRF"
+OP_N, OP_S, OP_E, OP_W, OP_L, OP_R, OP_F = range(len(OPCODES))
+# opcode of each byte, or -1
+OPCODE_OF_BYTE = np.full(256, -1, dtype=np.int8)
+OPCODE_OF_BYTE[np.frombuffer(OPCODES.encode(), np.uint8)] = np.arange(len(OPCODES))
+# the direction of each of N, S, E and W, as (x, y)
+MOVES = np.array([[0, 1], [0, -1], [1, 0], [-1, 0]])
+# the real and imaginary parts of 1j ** k, for k = 0, 1, 2, 3
+COS = np.array([1, 0, -1, 0])
+SIN = np.array([0, 1, 0, -1])
+
+
+# magnitudes with up to this many digits always fit in an int64
+MAX_INT64_DIGITS = 18
+
+
+def parse_instructions(text) -> tuple:
+    """
+    Parse the navigation instructions in `text` (one per line, like "F10")
+    into an array of opcodes (indices into `OPCODES`) and an array of
+    magnitudes, without a python loop over the lines.
+
+    Each byte that is an opcode starts an instruction, and the digits after
+    it are its magnitude: the digits are weighted by the power of ten for
+    their place (counted back from the last digit of the instruction) and
+    summed per instruction. Magnitudes with more digits than fit in int64
+    are summed as python ints instead (in an object array), so they are
+    always exact.
+    """
+    if isinstance(text, str):
+        text = text.encode()
+    data = np.frombuffer(text, np.uint8)
+    opcodes = OPCODE_OF_BYTE[data]
+    is_opcode = opcodes >= 0
+    is_digit = (data >= ord("0")) & (data <= ord("9"))
+    is_space = np.isin(data, np.frombuffer(b" \t\r\n", np.uint8))
+    if not (is_opcode | is_digit | is_space).all():
+        bad = bytes(data[~(is_opcode | is_digit | is_space)][:1])
+        print(f"ERROR: Unexpected character in instructions: {bad!r}")
+        sys.exit(1)
+
+    instruction = np.cumsum(is_opcode) - 1
+    digit_instruction = instruction[is_digit]
+    n_digits = np.bincount(digit_instruction, minlength=int(is_opcode.sum()))
+    if (digit_instruction < 0).any() or (n_digits == 0).any():
+        print("ERROR: Every instruction needs an opcode and a magnitude")
+        sys.exit(1)
+    # how many digits of the same instruction come after each digit
+    last_digit = np.cumsum(n_digits) - 1
+    place = last_digit[digit_instruction] - np.arange(len(digit_instruction))
+    if n_digits.max(initial=0) <= MAX_INT64_DIGITS:
+        values = (data[is_digit] - ord("0")).astype(np.int64) * 10 ** place
+    else:
+        digits = (data[is_digit] - ord("0")).astype(object)
+        values = digits * np.power(10, place.astype(object))
+    first_digit = last_digit - n_digits + 1
+    magnitudes = np.add.reduceat(values, first_digit) if len(values) else values
+    return opcodes[is_opcode].astype(np.uint8), magnitudes
+
+
+def quarter_turns(opcodes: np.ndarray, magnitudes: np.ndarray) -> np.ndarray:
+    """
+    The number of quarter turns (counter-clockwise) of each instruction,
+    i.e. the power of 1j that it rotates by, modulo 4.
+    """
+    turns = np.zeros(len(opcodes), dtype=np.int64)
+    left, right = opcodes == OP_L, opcodes == OP_R
+    rotations = magnitudes[left | right]
+    if (rotations % 90 != 0).any():
+        print("ERROR: Only turns by multiples of 90 degrees are supported")
+        sys.exit(1)
+    turns[left] = magnitudes[left] // 90 % 4
+    turns[right] = -(magnitudes[right] // 90 % 4)
+    return turns
+
+
+def exact_dtype(bound: int):
+    """
+    int64 if no value can get bigger than `bound`, otherwise python ints.
+    """
+    return np.int64 if bound < 2 ** 62 else object
+
+
+def total_bound(magnitudes: np.ndarray) -> int:
+    """
+    An upper bound on the sum of the magnitudes, without overflowing.
+    """
+    return int(magnitudes.max(initial=0)) * len(magnitudes)
+
+
+def moves(opcodes: np.ndarray, magnitudes: np.ndarray, dtype) -> tuple:
+    """
+    The (x, y) displacement of each of the N, S, E and W instructions
+    (zero for the others).
+    """
+    is_move = opcodes < len(MOVES)
+    directions = MOVES[np.where(is_move, opcodes, 0)]
+    magnitudes = np.where(is_move, magnitudes, 0).astype(dtype)
+    return directions[:, 0] * magnitudes, directions[:, 1] * magnitudes
+
+
+def navigate_heading(opcodes: np.ndarray, magnitudes: np.ndarray) -> tuple:
+    """
+    Vectorized version of `advance_ship_part1` over a whole route, giving
+    the final (x, y, heading in degrees) of the ship.
+
+    The heading is 1j ** k (starting East, at k = 0), so the heading at
+    each instruction is the cumulative sum of the quarter turns before
+    it, mod 4. The position is then the sum of the N, S, E and W moves and
+    of the forward moves along the heading at the time.
+    """
+    dtype = exact_dtype(total_bound(magnitudes))
+    headings = np.cumsum(quarter_turns(opcodes, magnitudes)) % 4
+    forward = np.where(opcodes == OP_F, magnitudes, 0).astype(dtype)
+    dx, dy = moves(opcodes, magnitudes, dtype)
+    x = (dx + COS[headings] * forward).sum()
+    y = (dy + SIN[headings] * forward).sum()
+    heading = int(headings[-1]) * 90 if len(headings) else 0
+    return int(x), int(y), heading
+
+
+def navigate_waypoint(
+    opcodes: np.ndarray, magnitudes: np.ndarray, waypoint: tuple = (10, 1)
+) -> tuple:
+    """
+    Vectorized version of `advance_ship_part2` over a whole route, giving
+    the final (x, y) of the ship and of the waypoint (relative to the ship).
+
+    As a complex number, the waypoint after each instruction is
+    w_t = 1j ** k_t * w_{t-1} + d_t, with k_t the quarter turns and d_t
+    the N, S, E or W move of the instruction. Seen from a frame that turns
+    along with it, u_t = 1j ** -K_t * w_t where K_t is the cumulative sum
+    of the k_t, the waypoint only ever moves: u_t = u_{t-1} + 1j ** -K_t d_t.
+    So the waypoint at every instruction comes from a cumulative sum of
+    the rotated moves, rotated back by 1j ** K_t, and the ship position is
+    the sum of the forward magnitudes times the waypoint at the time.
+
+    The complex numbers are kept as pairs of integer arrays, with the
+    powers of 1j looked up from `COS` and `SIN`, so the result is exact.
+    """
+    if not len(opcodes):
+        return 0, 0, waypoint[0], waypoint[1]
+    turns = np.cumsum(quarter_turns(opcodes, magnitudes)) % 4
+    # the waypoint only grows through the moves, and the ship by the forwards
+    move_bound = total_bound(np.where(opcodes < len(MOVES), magnitudes, 0))
+    forward_bound = total_bound(np.where(opcodes == OP_F, magnitudes, 0))
+    waypoint_bound = sum(abs(x) for x in waypoint) + move_bound
+    dtype = exact_dtype(waypoint_bound * max(forward_bound, 1))
+
+    dx, dy = moves(opcodes, magnitudes, dtype)
+    cos, sin = COS[turns], SIN[turns]
+    # rotate the moves by 1j ** -K into the turning frame, and add them up
+    ux = waypoint[0] + np.cumsum(cos * dx + sin * dy)
+    uy = waypoint[1] + np.cumsum(cos * dy - sin * dx)
+    # and back by 1j ** K
+    wx = cos * ux - sin * uy
+    wy = sin * ux + cos * uy
+
+    forward = np.where(opcodes == OP_F, magnitudes, 0).astype(dtype)
+    return (
+        int((forward * wx).sum()),
+        int((forward * wy).sum()),
+        int(wx[-1]),
+        int(wy[-1]),
+    )
+
+
+def random_route(n_instructions: int, seed: int = None) -> tuple:
+    """
+    A random route of `n_instructions`, as opcodes and magnitudes (turns
+    by multiples of 90 degrees, and moves of up to 100).
+    """
+    rng = np.random.default_rng(seed)
+    opcodes = rng.integers(0, len(OPCODES), n_instructions).astype(np.uint8)
+    magnitudes = rng.integers(1, 101, n_instructions)
+    is_turn = (opcodes == OP_L) | (opcodes == OP_R)
+    magnitudes[is_turn] = 90 * rng.integers(1, 4, int(is_turn.sum()))
+    return opcodes, magnitudes
+
+
+def benchmark(n_instructions: int):
+    """
+    Time the parsing and both parts on a random route of `n_instructions`.
+    """
+    opcodes, magnitudes = random_route(n_instructions)
+    text = "\n".join(
+        f"{OPCODES[op]}{mag}" for op, mag in zip(opcodes.tolist(), magnitudes.tolist())
+    ).encode()
+    print(f"BENCHMARK: {n_instructions} instructions ({len(text)} bytes)")
+    for name, run in [
+        ("parse", lambda: parse_instructions(text)),
+        ("part 1", lambda: navigate_heading(opcodes, magnitudes)),
+        ("part 2", lambda: navigate_waypoint(opcodes, magnitudes)),
+    ]:
+        start = time.perf_counter()
+        run()
+        print(f"BENCHMARK: {name:<7}: {time.perf_counter() - start:.3f} s")
+
+
+# padding for the routes of ships that have already stopped
+OP_NONE = len(OPCODES)
+
+
+class Fleet:
+    """
+    Many ships following their own routes in lockstep: the position and
+    the waypoint of every ship are (n_ships, 2) integer arrays, and each
+    step advances all of the ships that are still going by one
+    instruction, with a mask per kind of instruction.
+
+    With `use_waypoint`, the ships follow the part 2 rules (the
+    instructions move the waypoint), otherwise the part 1 rules.
+    """
+
+    def __init__(
+        self,
+        n_ships: int,
+        use_waypoint: bool = False,
+        waypoint: tuple = (10, 1),
+        dtype=np.int64,
+    ):
+        self.use_waypoint = use_waypoint
+        self.state = np.zeros((n_ships, 2), dtype=dtype)
+        self.heading = np.zeros(n_ships, dtype=np.int64)  # quarter turns from East
+        self.waypoint = np.tile(np.array(waypoint, dtype=dtype), (n_ships, 1))
+
+    def __len__(self):
+        return len(self.state)
+
+    def step(self, opcodes: np.ndarray, magnitudes: np.ndarray, ships=None):
+        """
+        Advance the ships `ships` (all of them if None) by one instruction
+        each, given by `opcodes` and `magnitudes` (ships with `OP_NONE`
+        stay as they are).
+        """
+        ships = slice(None) if ships is None else ships
+        magnitudes = magnitudes.astype(self.state.dtype)
+
+        is_move = opcodes < len(MOVES)
+        if is_move.any():
+            moved = self.waypoint if self.use_waypoint else self.state
+            directions = MOVES[np.where(is_move, opcodes, 0)]
+            moved[ships] += directions * np.where(is_move, magnitudes, 0)[:, None]
+
+        is_turn = (opcodes == OP_L) | (opcodes == OP_R)
+        if is_turn.any():
+            turns = quarter_turns(opcodes, magnitudes) % 4
+            if self.use_waypoint:
+                x, y = self.waypoint[ships, 0], self.waypoint[ships, 1]
+                cos, sin = COS[turns], SIN[turns]
+                self.waypoint[ships] = np.stack(
+                    [cos * x - sin * y, sin * x + cos * y], axis=1
+                )
+            else:
+                self.heading[ships] = (self.heading[ships] + turns) % 4
+
+        is_forward = opcodes == OP_F
+        if is_forward.any():
+            forward = np.where(is_forward, magnitudes, 0)[:, None]
+            if self.use_waypoint:
+                self.state[ships] += forward * self.waypoint[ships]
+            else:
+                heading = self.heading[ships]
+                directions = np.stack([COS[heading], SIN[heading]], axis=1)
+                self.state[ships] += forward * directions
+
+    def manhattan_distances(self) -> np.ndarray:
+        return np.abs(self.state).sum(axis=1)
+
+
+def fleet_dtype(routes: list, use_waypoint: bool):
+    """
+    The dtype that keeps the positions of the whole fleet exact (see
+    `navigate_heading` and `navigate_waypoint`).
+    """
+    bound = max([total_bound(magnitudes) for _, magnitudes in routes], default=0)
+    if use_waypoint:
+        bound = (10 + 1 + bound) * max(bound, 1)
+    return exact_dtype(bound)
+
+
+def pad_routes(routes: list) -> tuple:
+    """
+    Stack the (opcodes, magnitudes) routes of the ships into two
+    (n_steps, n_ships) arrays, padding the shorter routes with `OP_NONE`.
+    The magnitudes are python ints if those of any of the routes are.
+    """
+    n_steps = max([len(opcodes) for opcodes, _ in routes], default=0)
+    opcodes = np.full((n_steps, len(routes)), OP_NONE, dtype=np.uint8)
+    dtype = np.result_type(np.int64, *[magnitudes.dtype for _, magnitudes in routes])
+    magnitudes = np.zeros((n_steps, len(routes)), dtype=dtype)
+    for iship, (ship_opcodes, ship_magnitudes) in enumerate(routes):
+        opcodes[: len(ship_opcodes), iship] = ship_opcodes
+        magnitudes[: len(ship_magnitudes), iship] = ship_magnitudes
+    return opcodes, magnitudes
+
+
+def run_fleet_padded(routes: list, use_waypoint: bool = False) -> Fleet:
+    """
+    Run the routes of a fleet of ships, one (padded) step at a time.
+    """
+    fleet = Fleet(len(routes), use_waypoint, dtype=fleet_dtype(routes, use_waypoint))
+    for step_opcodes, step_magnitudes in zip(*pad_routes(routes)):
+        fleet.step(step_opcodes, step_magnitudes)
+    return fleet
+
+
+def run_fleet_grouped(routes: list, use_waypoint: bool = False) -> Fleet:
+    """
+    Run the routes of a fleet of ships without padding them, for routes
+    of very different lengths: the ships are ordered by decreasing route
+    length, so the ships still going at each step are the first few in
+    that order, and their instructions for the step are gathered from the
+    concatenated routes.
+    """
+    fleet = Fleet(len(routes), use_waypoint, dtype=fleet_dtype(routes, use_waypoint))
+    if not routes:
+        return fleet
+    lengths = np.array([len(opcodes) for opcodes, _ in routes])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    all_opcodes = np.concatenate([opcodes for opcodes, _ in routes])
+    all_magnitudes = np.concatenate([magnitudes for _, magnitudes in routes])
+
+    order = np.argsort(-lengths, kind="stable")
+    # the number of ships with routes longer than each step
+    n_going = np.searchsorted(-lengths[order], -np.arange(lengths.max()), "left")
+    for istep, n_ships in enumerate(n_going.tolist()):
+        ships = order[:n_ships]
+        index = starts[ships] + istep
+        fleet.step(all_opcodes[index], all_magnitudes[index], ships)
+    return fleet
+
+
 def main(input_path):
 
-    with open(input_path, "r") as ifile:
-        instructions = [x.strip() for x in ifile]
-    print(f"loaded {len(instructions)} instructions")
+    with open(input_path, "rb") as ifile:
+        opcodes, magnitudes = parse_instructions(ifile.read())
+    print(f"loaded {len(opcodes)} instructions")
 
     # part 1
-    ship = Ship()
-    for instruction in instructions:
-        advance_ship_part1(ship, instruction)
-    print(f"PART 1: Final ship state   : {ship.state}")
-    manhattan_distance = int(sum([abs(x) for x in ship.state[:2]]))
+    x, y, heading = navigate_heading(opcodes, magnitudes)
+    print(f"PART 1: Final ship state   : {[x, y, heading]}")
+    manhattan_distance = abs(x) + abs(y)
     print(f"PART 1: Manhattan distance : {manhattan_distance}")
 
     # part 2
-    ship = Ship()
-    for instruction in instructions:
-        advance_ship_part2(ship, instruction)
-    print(f"PART 2: Final ship state   : {ship.state}")
-    print(f"PART 2: Final waypoint     : {ship.waypoint}")
-    manhattan_distance = int(sum([abs(x) for x in ship.state[:2]]))
+    x, y, waypoint_x, waypoint_y = navigate_waypoint(opcodes, magnitudes)
+    print(f"PART 2: Final ship state   : {[x, y]}")
+    print(f"PART 2: Final waypoint     : {[waypoint_x, waypoint_y]}")
+    manhattan_distance = abs(x) + abs(y)
     print(f"PART 2: Manhattan distance : {manhattan_distance}")
 
 
+def main_fleet(input_paths: list):
+    """
+    Run the navigation logs in `input_paths` as a single fleet, one ship
+    per log, printing the Manhattan distances of each ship for both parts.
+    """
+    routes = []
+    for input_path in input_paths:
+        with open(input_path, "rb") as ifile:
+            routes.append(parse_instructions(ifile.read()))
+    print(f"loaded {len(routes)} ships, {sum(len(x) for x, _ in routes)} instructions")
+
+    distances_part1 = run_fleet_grouped(routes).manhattan_distances()
+    distances_part2 = run_fleet_grouped(routes, True).manhattan_distances()
+    for input_path, part1, part2 in zip(input_paths, distances_part1, distances_part2):
+        print(f"{input_path}: PART 1: {part1}, PART 2: {part2}")
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(description="AoC day #12")
-    parser.add_argument("input", help="Day #12 input file")
+    parser.add_argument(
+        "input",
+        nargs="*",
+        help="Day #12 input file (or the navigation logs of a whole fleet)",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=None,
+        help="Time the navigation on a random route of this many instructions instead",
+    )
     args = parser.parse_args()
-    input_path = Path(args.input)
-    if not input_path.exists():
-        print(f"ERROR: bad input '{args.input}'")
-        sys.exit(1)
-    main(input_path)
+    if args.benchmark:
+        benchmark(args.benchmark)
+        sys.exit(0)
+    if not args.input:
+        parser.error("the input file is required")
+    input_paths = [Path(x) for x in args.input]
+    for input_path in input_paths:
+        if not input_path.exists():
+            print(f"ERROR: bad input '{input_path}'")
+            sys.exit(1)
+    if len(input_paths) > 1:
+        main_fleet(input_paths)
+    else:
+        main(input_paths[0])